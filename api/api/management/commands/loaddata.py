@@ -13,8 +13,12 @@ STATE = {
 
 class Command(loaddata.Command):
 
-    # override loaddata so that it never schedules emails to go out
+    # override loaddata so that it never schedules emails to go out and
+    # so that materialized balances agree with the raw-loaded transfers
     def handle(self, *args, **options):
+        import ibis.models
+
         STATE['LOADING_DATA'] = True
         super(Command, self).handle(*args, **options)
+        ibis.models.rebuild_accounts()
         STATE['LOADING_DATA'] = False
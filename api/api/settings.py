@@ -257,6 +257,8 @@ BOT_GAS_MUTATION = {
     'createDeposit': 100,
     'createDonation': 100,
     'createTransaction': 100,
+    'createTransfers': 500,
+    'createRecurringDonation': 100,
     'createNews': 100,
     'createEvent': 100,
     'createPost': 100,
@@ -267,6 +269,7 @@ BOT_GAS_MUTATION = {
     'createRSVP': 100,
     'updatePerson': 100,
     'updateBot': 100,
+    'deleteRecurringDonation': 100,
     'deleteFollow': 100,
     'deleteLike': 100,
     'deleteBookmark': 100,
@@ -285,6 +288,8 @@ DISTRIBUTION_DAY = CONF['ibis']['distribution']['day']
 
 DISTRIBUTION_HORIZON = 3
 
+DISTRIBUTION_CHUNK_SIZE = 1000
+
 DISTRIBUTION_CONTROLLER_KP = 0.25
 
 DISTRIBUTION_CONTROLLER_TI = 1
@@ -308,10 +313,20 @@ EMAIL_USE_TLS = True
 
 IBIS_USERNAME_ROOT = 'tokenibis'
 
+USERNAME_RETRIES = 3
+
+AUTOCOMPLETE_SIZE = 8
+
 IBIS_CATEGORY_UBP = 'ubp'
 
 MAX_TRANSFER = 10000
 
+TRANSFER_RETRIES = 3
+
+MAX_TRANSFER_BATCH = 100
+
+IDEMPOTENCY_KEY_TTL = 24  # hours
+
 MAX_EXCHANGE = 100000
 
 PAYPAL_USE_SANDBOX = CONF['payment']['paypal']['use_sandbox']
@@ -336,6 +351,8 @@ REDIRECT_URL_MICROSOFT = 'https://{}/redirect/microsoft/'.format(
 REDIRECT_URL_NOTIFICATIONS = 'https://{}/#/_/Settings'.format(
     CONF['ibis']['endpoints']['app'])
 
+REFERENCE_CACHE_TTL = 10  # seconds
+
 RESERVED_USERNAMES = ['admin', 'anonymous', 'dashboard']
 
 API_ROOT_PATH = 'https://{}'.format(CONF['ibis']['endpoints']['api'])
@@ -344,4 +361,13 @@ APP_ROOT_PATH = 'https://{}'.format(CONF['ibis']['endpoints']['app'])
 
 SIGNAL_SCORE_NONPROFIT = 'fundraised_descending'
 
+TRENDING_DECAY = 24  # hours
+
+TRENDING_WEIGHTS = {
+    'like': 1,
+    'comment': 2,
+    'rsvp': 2,
+    'mention': 1,
+}
+
 UNSUBSCRIBE_EMAIL = 'unsubscribe@tokenibis.org?subject=unsubscribe'
@@ -3,7 +3,9 @@ import json
 import logging
 import random
 
+from contextlib import contextmanager
 from django.core.management import call_command
+from django.db import connection
 from django.conf import settings
 from django.utils.timezone import now, localtime, utc
 from graphene_django.utils.testing import GraphQLTestCase
@@ -63,6 +65,19 @@ with freeze_time(TEST_TIME.astimezone(utc).date()):
     )
 
 
+@contextmanager
+def run_on_commit():
+    """Run the on_commit callbacks registered within the block as if its
+    transaction committed, since test cases never commit"""
+    start = len(connection.run_on_commit)
+    yield
+    while len(connection.run_on_commit) > start:
+        callbacks = connection.run_on_commit[start:]
+        start = len(connection.run_on_commit)
+        for _, callback in callbacks:
+            callback()
+
+
 class BaseTestCase(GraphQLTestCase):
     fixtures = sorted([
         x.split('/')[-1] for x in os.listdir(os.path.join(DIR, '../fixtures'))
@@ -298,8 +313,10 @@ class BaseTestCase(GraphQLTestCase):
             body["operationName"] = op_name
         if variables:
             body["variables"] = variables
-        resp = self._client.post(
-            self.GRAPHQL_URL,
-            json.dumps(body),
-            content_type="application/json")
+        # each request commits in production, along with its on_commit work
+        with run_on_commit():
+            resp = self._client.post(
+                self.GRAPHQL_URL,
+                json.dumps(body),
+                content_type="application/json")
         return resp
@@ -4,13 +4,16 @@ import random
 import ibis.models
 import distribution.models
 import distribution.signals
+import notifications.models
+import distribution.management.commands.backtest as backtest
 
+from io import StringIO
 from django.db.models import Sum
 from django.core import management
 from django.utils.timezone import localtime, timedelta, utc
 from django.conf import settings
 from freezegun import freeze_time
-from api.test.base import BaseTestCase, TEST_TIME
+from api.test.base import BaseTestCase, TEST_TIME, run_on_commit
 from graphql_relay.node.node import to_global_id
 
 DIR = os.path.dirname(os.path.realpath(__file__))
@@ -33,6 +36,7 @@ class DistributionTestCase(BaseTestCase):
         settings.DISTRIBUTION_GOAL = 100000
         self._max_transfer_old = settings.MAX_TRANSFER
         settings.MAX_TRANSFER = 1e20
+        self._chunk_size_old = settings.DISTRIBUTION_CHUNK_SIZE
         if hasattr(settings, 'DISTRIBUTION_INITIAL'):
             del settings.DISTRIBUTION_INITIAL
 
@@ -40,6 +44,7 @@ class DistributionTestCase(BaseTestCase):
 
     def tearDown(self, *args, **kwargs):
         settings.MAX_TRANSFER = self._max_transfer_old
+        settings.DISTRIBUTION_CHUNK_SIZE = self._chunk_size_old
         super().tearDown(*args, **kwargs)
 
     def _donate(self, user, target, amount):
@@ -76,13 +81,14 @@ class DistributionTestCase(BaseTestCase):
             amount=amount,
             payment_id=str(random.random()),
             category=ibis.models.DepositCategory.objects.exclude(
-                id=UBP_CATEGORY).first(),
+                id=UBP_CATEGORY.id).first(),
         )
 
     def _fast_forward_cron(self, frozen_datetime, number, **kwargs):
         for _ in range(number):
             frozen_datetime.tick(delta=timedelta(**kwargs))
-            management.call_command('distribute')
+            with run_on_commit():
+                management.call_command('distribute')
 
     def test_times(self):
         with freeze_time(TEST_TIME.astimezone(utc).date()) as frozen_datetime:
@@ -122,6 +128,356 @@ class DistributionTestCase(BaseTestCase):
         assert person2.deposit_set.count() == 1
         assert person2.balance() != 1000
 
+    def test_initial_epoch(self):
+        people = [
+            ibis.models.Person.objects.create(
+                username=str(random.random())[:15],
+                password='password',
+                first_name='Person',
+                last_name='McPersonFace_Epoch_{}'.format(i),
+            ) for i in range(3)
+        ]
+
+        assert all(x.balance() > 0 for x in people)
+
+        # the cached epoch matches one computed from scratch
+        step = distribution.models.to_step_start(localtime())
+        cached = distribution.models.Epoch.objects.get(step=step)
+        distribution.models.Epoch.objects.filter(step=step).delete()
+        fresh = distribution.models.Epoch.load(localtime())
+        assert fresh.step == step
+        assert cached.amount == fresh.amount
+        assert cached.weight == fresh.weight
+        assert cached.recipients == fresh.recipients
+        assert cached.deposits == fresh.deposits
+
+    def test_checkpoints(self):
+        with freeze_time(TEST_TIME.astimezone(utc).date()) as frozen_datetime:
+            settings.DISTRIBUTION_INITIAL = 1000
+            people = [
+                ibis.models.Person.objects.create(
+                    username=str(random.random())[:15],
+                    password='password',
+                    first_name='Person',
+                    last_name='McPersonFace_Checkpoint_{}'.format(i),
+                ) for i in range(3)
+            ]
+            del settings.DISTRIBUTION_INITIAL
+
+            times = []
+            for _ in range(4):
+                for person in people:
+                    self._deposit(person, random.randint(1, 100))
+                    self._transact(person, random.choice(people), 1)
+                times.append(localtime())
+                self._fast_forward_cron(frozen_datetime, 7, days=1)
+
+            assert distribution.models.Checkpoint.objects.exists()
+
+            for person in people + [self.nonprofit]:
+                for time in times:
+                    assert distribution.models.get_historical_balance(
+                        person, time) == ibis.models.calculate_balances(
+                            [person.id], end=time)[person.id]
+                assert distribution.models.get_historical_balance(
+                    person, localtime()) == person.balance()
+
+            # backdated transfers invalidate later checkpoints
+            ibis.models.Deposit.objects.create(
+                user=people[0],
+                amount=100,
+                payment_id=str(random.random()),
+                category=ibis.models.DepositCategory.objects.exclude(
+                    id=UBP_CATEGORY.id).first(),
+                created=times[0],
+            )
+            assert not distribution.models.Checkpoint.objects.filter(
+                step__gt=times[0]).exists()
+            assert distribution.models.get_historical_balance(
+                people[0], localtime()) == people[0].balance()
+
+            management.call_command('checkpoint')
+            assert distribution.models.Checkpoint.objects.filter(
+                step__gt=times[0]).exists()
+            for time in times:
+                assert distribution.models.get_historical_balance(
+                    people[0], time) == ibis.models.calculate_balances(
+                        [people[0].id], end=time)[people[0].id]
+
+    def test_recurring(self):
+        person = ibis.models.Person.objects.first()
+        nonprofits = list(ibis.models.Nonprofit.objects.all()[:2])
+
+        with freeze_time(TEST_TIME.astimezone(utc).date()) as frozen_datetime:
+            self._fast_forward_cron(frozen_datetime, 1, days=7)
+            self._deposit(person, 1000)
+            pledges = [
+                ibis.models.RecurringDonation.objects.create(
+                    user=person,
+                    target=nonprofits[0],
+                    amount=person.balance() - 1,
+                    description='This is a pledge for @{}'.format(
+                        nonprofits[1].username),
+                ),
+                ibis.models.RecurringDonation.objects.create(
+                    user=person,
+                    target=nonprofits[1],
+                    amount=2,
+                    description='This is an unaffordable pledge',
+                ),
+            ]
+
+            count = ibis.models.Donation.objects.count()
+            balance = nonprofits[0].balance()
+
+            # settled once per epoch, skipping what the user cannot afford
+            self._fast_forward_cron(frozen_datetime, 2, days=1)
+            assert ibis.models.Donation.objects.count() == count + 1
+            assert nonprofits[0].balance() == balance + pledges[0].amount
+            assert person.balance() < pledges[0].amount
+
+            # settled donations resolve mentions like any other donation
+            donation = ibis.models.Donation.objects.order_by('id').last()
+            assert donation.rendered_description == pledges[0].description
+            assert list(donation.mention.values_list(
+                'id', flat=True)) == [nonprofits[1].id]
+
+            pledges[0].active = False
+            pledges[0].save()
+            self._deposit(person, 1000)
+            self._fast_forward_cron(frozen_datetime, 7, days=1)
+            assert ibis.models.Donation.objects.count() == count + 2
+            assert ibis.models.rebuild_accounts() == 0
+
+        # pledges are only listed to their owner
+        self._client.logout()
+        result = json.loads(
+            self.query(
+                'query { allRecurringDonations { edges { node { id } } } }',
+                op_name=None,
+                variables=None,
+            ).content)
+        assert result['errors'][0]['message'] == 'You are not logged in'
+
+    def test_weekly_flow(self):
+        person = ibis.models.Person.objects.first()
+        nonprofit = ibis.models.Nonprofit.objects.first()
+
+        with freeze_time(TEST_TIME.astimezone(utc).date()) as frozen_datetime:
+            for _ in range(4):
+                self._deposit(person, 1000)
+                self._donate(person, nonprofit, 500)
+                self._fast_forward_cron(frozen_datetime, 1, days=7)
+
+            history = distribution.models.get_control_history(localtime())
+            steps = [
+                distribution.models.to_step_start(x.created)
+                for x in distribution.models.Goal.objects.order_by('created')
+            ]
+
+            # closed epochs are rolled up once and match a fresh scan
+            assert distribution.models.WeeklyFlow.objects.filter(
+                step__in=steps).count() == len(steps) - 1
+            assert history == distribution.models.get_control_history(
+                localtime())
+            distribution.models.WeeklyFlow.objects.all().delete()
+            assert history == distribution.models.get_control_history(
+                localtime())
+
+            # backdated transfers invalidate the epoch they land in
+            ibis.models.Deposit.objects.create(
+                user=person,
+                amount=100,
+                payment_id=str(random.random()),
+                category=ibis.models.DepositCategory.objects.exclude(
+                    id=UBP_CATEGORY.id).first(),
+                created=steps[1],
+            )
+            assert not distribution.models.WeeklyFlow.objects.filter(
+                step=steps[1]).exists()
+            assert distribution.models.get_control_history(
+                localtime())[1][1] == history[1][1] - 100
+
+            # only the epoch of the transfer is dropped, not its neighbours
+            ibis.models.Deposit.objects.create(
+                user=person,
+                amount=100,
+                payment_id=str(random.random()),
+                category=ibis.models.DepositCategory.objects.exclude(
+                    id=UBP_CATEGORY.id).first(),
+                created=steps[2] + timedelta(days=3),
+            )
+            assert set(
+                distribution.models.WeeklyFlow.objects.filter(
+                    step__in=steps).values_list('step', flat=True)) == set(
+                        steps[:-1]) - set([steps[2]])
+
+    def test_payouts(self):
+        with freeze_time(TEST_TIME.astimezone(utc).date()):
+            weights = distribution.models.get_distribution_weights(localtime())
+            shares = distribution.models.get_distribution_shares(localtime())
+            assert set(weights) == set(shares)
+            assert abs(sum(shares.values()) - 1) < 1e-9
+
+            for amount in [1, 999, 100000, 123456.7]:
+                payouts = distribution.models.get_distribution_payouts(
+                    localtime(), amount)
+                assert set(payouts) == set(weights)
+                assert sum(payouts.values()) == round(amount)
+                assert all(
+                    abs(payouts[x] - payouts[y]) <= 1 for x in weights
+                    for y in weights if weights[x] == weights[y])
+
+    def test_distribute_amount(self):
+        with freeze_time(TEST_TIME.astimezone(utc).date()) as frozen_datetime:
+            self._fast_forward_cron(frozen_datetime, 2, days=7)
+
+            # every cent of each run is paid out within the run
+            for run in distribution.models.DistributionRun.objects.all():
+                assert ibis.models.Deposit.objects.filter(
+                    category=UBP_CATEGORY,
+                    created__gte=run.step,
+                    created__lt=distribution.models.to_step_start(
+                        run.step, offset=1),
+                ).aggregate(total=Sum('amount'))['total'] == round(run.amount)
+
+    def test_distribute_bulk(self):
+        settings.DISTRIBUTION_CHUNK_SIZE = 2
+
+        with freeze_time(TEST_TIME.astimezone(utc).date()) as frozen_datetime:
+            self._fast_forward_cron(frozen_datetime, 1, days=7)
+            step = distribution.models.to_step_start(localtime())
+            deposits = ibis.models.Deposit.objects.filter(
+                category=UBP_CATEGORY,
+                created__gte=step,
+            )
+
+            assert deposits.exists()
+            assert all(
+                notifications.models.UbpNotification.objects.filter(
+                    subject=x).count() == 1 for x in deposits)
+            assert ibis.models.rebuild_accounts() == 0
+
+            # people paid in this epoch are skipped on a second run
+            payouts = {x.user.person: 100 for x in deposits}
+            assert distribution.models.distribute_payouts_safe(
+                localtime(), payouts) == []
+
+    def test_distribute_resume(self):
+        with freeze_time(TEST_TIME.astimezone(utc).date()) as frozen_datetime:
+            self._fast_forward_cron(frozen_datetime, 1, days=7)
+            frozen_datetime.tick(delta=timedelta(days=7))
+
+            # simulate a run that stopped after its first chunk
+            time = localtime()
+            run = distribution.models.DistributionRun.objects.create(
+                step=distribution.models.to_step_start(time),
+                created=time,
+                amount=distribution.models.get_distribution_amount(time),
+            )
+            payouts = distribution.models.get_distribution_payouts(
+                time, run.amount)
+            first = sorted((x.id, payouts[x]) for x in payouts)[:2]
+            run.advance(
+                distribution.models.distribute_chunk_safe((time, first)))
+
+            management.call_command('distribute', '--chunk_size', '2')
+
+            run.refresh_from_db()
+            assert run.completed
+            assert run.cursor == max(x.id for x in payouts)
+            deposits = ibis.models.Deposit.objects.filter(
+                category=UBP_CATEGORY,
+                created__gte=run.step,
+            )
+            assert deposits.count() == len(payouts)
+            assert all(x.amount == payouts[x.user.person] for x in deposits)
+            assert distribution.models.distribute_all_safe() is None
+
+    def test_forecast(self):
+        person = ibis.models.Person.objects.order_by('id').last()
+        nonprofit = ibis.models.Nonprofit.objects.first()
+
+        with freeze_time(TEST_TIME.astimezone(utc).date()) as frozen_datetime:
+            self._fast_forward_cron(frozen_datetime, 2, days=7)
+            forecast = distribution.models.Forecast.objects.get()
+
+            # incremental share updates match a full refresh
+            self._deposit(person, 1000)
+            self._donate(person, nonprofit, 100)
+            forecast.refresh_from_db()
+            fresh = distribution.models.refresh_forecast(localtime())
+            assert forecast.weight == fresh.weight
+            assert forecast.recipients == fresh.recipients
+
+            self._client.force_login(person)
+            result = json.loads(
+                self.query(
+                    '''
+                    query Forecast($id: ID!) {
+                        distributionForecast {
+                            amount
+                            recipients
+                        }
+                        person(id: $id) {
+                            distributionForecast
+                        }
+                    }
+                    ''',
+                    op_name='Forecast',
+                    variables={
+                        'id': to_global_id('PersonNode', person.id),
+                    },
+                ).content)
+
+            assert result['data']['distributionForecast'][
+                'recipients'] == fresh.recipients
+            assert result['data']['person'][
+                'distributionForecast'] == distribution.models.Forecast.get_payout(
+                    person, localtime()) > 0
+
+    def test_backtest(self):
+        person = ibis.models.Person.objects.first()
+        nonprofit = ibis.models.Nonprofit.objects.first()
+
+        with freeze_time(TEST_TIME.astimezone(utc).date()) as frozen_datetime:
+            for _ in range(5):
+                self._donate(person, nonprofit, person.balance() // 2)
+                self._fast_forward_cron(frozen_datetime, 1, days=7)
+
+            history = distribution.models.get_control_history(localtime())
+
+            # the current parameters replay the actual controller output
+            assert distribution.models.get_distribution_amount(
+                localtime()) == distribution.models.compute_distribution_amount(
+                    [x[1] - x[0] for x in history],
+                    settings.DISTRIBUTION_GOAL,
+                    settings.DISTRIBUTION_CONTROLLER_KP,
+                    settings.DISTRIBUTION_CONTROLLER_TI,
+                    settings.DISTRIBUTION_CONTROLLER_TD,
+                )
+
+            error, _ = backtest.simulate(history, [0] * len(history), 0.25, 1,
+                                         0.5, 0)
+            assert error == [x[1] - x[0] for x in history]
+
+            out = StringIO()
+            management.call_command(
+                'backtest',
+                '--kp',
+                '0.1',
+                '0.25',
+                '--td',
+                '0',
+                '0.5',
+                '--horizon',
+                '2',
+                '3',
+                stdout=out,
+            )
+            assert '{} week(s), 8 scenario(s)'.format(
+                len(history)) in out.getvalue()
+
     def test_distribution(self):
         def _create_person(activity):
             activity[ibis.models.Person.objects.create(
@@ -151,8 +507,9 @@ class DistributionTestCase(BaseTestCase):
 
             for i, x in enumerate(by_tier):
                 if x:
-                    # make sure that all users in same tier gets same payout
-                    assert all(y == x[0] for y in x)
+                    # make sure that all users in same tier get the same
+                    # payout, up to the cent that makes the total exact
+                    assert max(x) - min(x) <= 1
 
                     # check exponential backoff
                     if by_tier[0]:
@@ -278,3 +278,24 @@ class NotificationTestCase(BaseTestCase):
                 status=notifications.models.Email.SUCCEEDED).count() == 16
             assert notifications.models.Email.objects.filter(
                 status=notifications.models.Email.UNNEEDED).count() == 1
+
+    # reference data is served from the process cache until it changes
+    def test_reference_cache(self):
+        ubp = models.get_deposit_category(settings.IBIS_CATEGORY_UBP)
+        templates = notifications.models.EmailTemplateUBP.active()
+        assert models.get_deposit_category(settings.IBIS_CATEGORY_UBP) is ubp
+        assert notifications.models.EmailTemplateUBP.active() is templates
+        assert models.get_root_nonprofit().username == \
+            settings.IBIS_USERNAME_ROOT
+
+        notifications.models.EmailTemplateUBP.objects.create(
+            subject='Subject',
+            body='{amount} {link}',
+            html='{amount} {link}',
+        )
+        assert len(notifications.models.EmailTemplateUBP.active()) == len(
+            templates) + 1
+
+        ubp.save()
+        assert models.get_deposit_category(
+            settings.IBIS_CATEGORY_UBP) is not ubp
@@ -1,10 +1,25 @@
+import csv
 import json
 import random
+import threading
+import dateutil.parser
+from io import StringIO
+from unittest import mock
 import ibis.models as models
 
 from django.conf import settings
+from django.core import management
+from django.core.management.base import CommandError
+from django.db import connection, transaction
+from django.db.models import Q
+from django.test import TransactionTestCase
+from django.utils.timezone import now, timedelta
 from graphql_relay.node.node import to_global_id
-from api.test.base import BaseTestCase
+from ibis.payments import PayPalClient
+from api.management.commands.loaddata import STATE
+from api.test.base import BaseTestCase, run_on_commit
+
+NUM_THREADS = 20
 
 
 class TransferTestCase(BaseTestCase):
@@ -243,3 +258,559 @@ class TransferTestCase(BaseTestCase):
         for x in nonprofit_state:
             assert nonprofit_state[x]['balance'] == x.balance()
             assert nonprofit_state[x]['fundraised'] == x.fundraised()
+
+        # materialized balances must agree with the transfer tables
+        assert models.rebuild_accounts() == 0
+
+    # the bulk aggregates agree with the per-user totals
+    def test_aggregate_totals(self):
+        people = [self.me_person, self.person]
+        nonprofits = [self.me_nonprofit, self.nonprofit]
+        start = now() - timedelta(days=2)
+        end = now() - timedelta(days=1)
+
+        for i, created in enumerate([start - timedelta(hours=1), start, end]):
+            for user, target in [
+                (people[0], people[1]),
+                (people[1], nonprofits[0]),
+                (nonprofits[1], nonprofits[0]),
+            ]:
+                models.Deposit.objects.create(
+                    user=user,
+                    amount=300 + i,
+                    payment_id='aggregate_{}_{}'.format(user.id, i),
+                    category=models.DepositCategory.objects.first(),
+                    created=created,
+                )
+                (models.Donation if isinstance(target, models.Nonprofit)
+                 else models.Transaction).objects.create(
+                     user=user,
+                     target=target,
+                     amount=200 + i,
+                     description='This is a transfer',
+                     created=created,
+                 )
+                if isinstance(user, models.Nonprofit):
+                    models.Withdrawal.objects.create(
+                        user=user,
+                        amount=50 + i,
+                        description='This is a withdrawal',
+                        created=created,
+                    )
+
+        users = list(models.IbisUser.objects.all())
+        ids = [x.id for x in users]
+
+        def total(user, kinds, start=None, end=None):
+            return sum(
+                sign * x.amount
+                for queryset, sign in kinds(user) for x in queryset
+                if (not start or x.created >= start) and (
+                    not end or x.created < end))
+
+        def balance(user):
+            return [
+                (models.Deposit.objects.filter(user_id=user.id), 1),
+                (models.Donation.objects.filter(target=user), 1),
+                (models.Transaction.objects.filter(target=user), 1),
+                (models.Donation.objects.filter(user=user), -1),
+                (models.Transaction.objects.filter(user=user), -1),
+                (models.Withdrawal.objects.filter(user_id=user.id), -1),
+            ]
+
+        balances = models.calculate_balances(ids)
+        assert balances == models.calculate_balances()
+        assert all(balances[x.id] == x.balance() for x in users)
+        assert all(balances[x.id] == total(x, balance) for x in users)
+
+        windowed = models.calculate_balances(ids, start, end)
+        changes = models.calculate_balance_changes(start, end)
+        for x in users:
+            assert windowed[x.id] == total(x, balance, start, end)
+            assert changes.get(x.id, 0) == windowed[x.id]
+        assert changes[people[0].id] != 0
+
+        donated = models.calculate_donated(ids)
+        assert all(donated[x.id] == x.donated() for x in users)
+        assert all(donated[x.id] == total(
+            x, lambda y: [(models.Donation.objects.filter(user=y), 1)])
+                   for x in users)
+
+        nonprofits = list(models.Nonprofit.objects.all())
+        fundraised = models.calculate_fundraised([x.id for x in nonprofits])
+        assert all(fundraised[x.id] == x.fundraised() for x in nonprofits)
+        assert all(fundraised[x.id] == total(
+            x, lambda y: [(models.Donation.objects.filter(target=y), 1)])
+                   for x in nonprofits)
+
+    # walk the statement pages and make sure the running balance is chained
+    def test_account_statement(self):
+        query = '''
+        query AccountStatement($user: ID! $first: Int $after: String) {
+            accountStatement(user: $user first: $first after: $after) {
+                pageInfo {
+                    hasNextPage
+                    endCursor
+                }
+                edges {
+                    node {
+                        kind
+                        created
+                        amount
+                        balance
+                    }
+                }
+            }
+        }
+        '''
+
+        self._client.force_login(self.me_person)
+
+        rows = []
+        after = None
+        while True:
+            result = json.loads(
+                self.query(
+                    query,
+                    op_name='AccountStatement',
+                    variables={
+                        'user': self.me_person.gid,
+                        'first': 2,
+                        'after': after,
+                    },
+                ).content)
+            assert 'errors' not in result
+            statement = result['data']['accountStatement']
+            rows += [x['node'] for x in statement['edges']]
+            if not statement['pageInfo']['hasNextPage']:
+                break
+            after = statement['pageInfo']['endCursor']
+
+        assert rows[0]['balance'] == self.me_person.balance()
+        assert rows[-1]['balance'] == rows[-1]['amount']
+        assert all(rows[i]['balance'] - rows[i]['amount'] == rows[i +
+                                                                  1]['balance']
+                   for i in range(len(rows) - 1))
+
+        assert all(
+            dateutil.parser.parse(rows[i]['created']) >=
+            dateutil.parser.parse(rows[i + 1]['created'])
+            for i in range(len(rows) - 1))
+
+        assert 'errors' in json.loads(
+            self.query(
+                query,
+                op_name='AccountStatement',
+                variables={'user': self.person.gid},
+            ).content)
+
+        # cursors carry the balance, so forged or foreign ones are rejected
+        cursor = statement['pageInfo']['endCursor'] or after
+        self._client.force_login(self.staff)
+        for user, cursor in [
+            (self.me_person.gid, cursor + 'x'),
+            (self.person.gid, cursor),
+        ]:
+            assert 'errors' in json.loads(
+                self.query(
+                    query,
+                    op_name='AccountStatement',
+                    variables={
+                        'user': user,
+                        'after': cursor,
+                    },
+                ).content)
+
+    # side effects of a transfer follow once its transaction commits
+    def test_transfer_on_commit(self):
+        balance = self.nonprofit.balance()
+        count = self.nonprofit.notifier.notification_set.count()
+
+        with run_on_commit():
+            with transaction.atomic():
+                donation = models.create_transfer(
+                    models.Donation,
+                    user=self.me_person,
+                    target=self.nonprofit,
+                    amount=100,
+                    description='Hello @{}'.format(self.person.username),
+                )
+                assert self.nonprofit.balance() == balance + 100
+                assert self.nonprofit.notifier.notification_set.count(
+                ) == count
+                assert not donation.mention.exists()
+
+        assert self.nonprofit.notifier.notification_set.count() == count + 1
+        assert list(donation.mention.values_list(
+            'id', flat=True)) == [self.person.id]
+
+    # batches are all or nothing and match individual transfers
+    def test_transfers_bulk(self):
+        query = '''
+        mutation TransfersCreate($user: ID! $transfers: [TransferInput]!) {
+            createTransfers(user: $user transfers: $transfers) {
+                donations {
+                    id
+                }
+                transactions {
+                    id
+                }
+            }
+        }
+        '''
+
+        self._client.force_login(self.me_person)
+
+        def transfer(amounts):
+            return json.loads(
+                self.query(
+                    query,
+                    op_name='TransfersCreate',
+                    variables={
+                        'user':
+                        self.me_person.gid,
+                        'transfers': [{
+                            'target':
+                            [self.nonprofit.gid, self.person.gid][i % 2],
+                            'amount':
+                            x,
+                            'description':
+                            'This is a description',
+                        } for i, x in enumerate(amounts)],
+                    },
+                ).content)
+
+        balance = self.me_person.balance()
+        nonprofit_balance = self.nonprofit.balance()
+        person_balance = self.person.balance()
+        notification_count = self.nonprofit.notifier.notification_set.count()
+
+        assert 'errors' in transfer([])
+        assert 'errors' in transfer([100, 0])
+        assert 'errors' in transfer([balance, 1])
+        assert self.me_person.balance() == balance
+
+        result = transfer([100, 200, 300])
+        assert 'errors' not in result
+        assert len(result['data']['createTransfers']['donations']) == 2
+        assert len(result['data']['createTransfers']['transactions']) == 1
+
+        assert self.me_person.balance() == balance - 600
+        assert self.nonprofit.balance() == nonprofit_balance + 400
+        assert self.person.balance() == person_balance + 200
+        assert self.nonprofit.notifier.notification_set.count(
+        ) == notification_count + 2
+        assert models.rebuild_accounts() == 0
+
+        # malformed and unknown targets fail before anything is transferred
+        for target in ['invalid', to_global_id('PersonNode', 'invalid'),
+                       to_global_id('PersonNode', 0)]:
+            result = json.loads(
+                self.query(
+                    query,
+                    op_name='TransfersCreate',
+                    variables={
+                        'user': self.me_person.gid,
+                        'transfers': [{
+                            'target': target,
+                            'amount': 100,
+                            'description': 'This is a description',
+                        }],
+                    },
+                ).content)
+            assert result['errors'][0]['message'] == \
+                'Transfer target does not exist'
+        assert self.me_person.balance() == balance - 600
+
+        # notifications of loaded data are marked as read, as when saved
+        with mock.patch.dict(STATE, {'LOADING_DATA': True}), run_on_commit():
+            donation = models.create_transfers(
+                self.me_person,
+                [{
+                    'target': self.nonprofit,
+                    'description': 'This is a description',
+                    'amount': 100,
+                }],
+            )[0]
+        assert donation.donationnotification_set.get().clicked
+
+    # retried requests with the same key only transfer once
+    def test_transfer_idempotency(self):
+        query = '''
+        mutation DonationCreate(
+            $user: ID! $target: ID! $amount: Int! $key: String
+        ) {
+            createDonation(
+                user: $user
+                target: $target
+                amount: $amount
+                description: "This is a description"
+                idempotencyKey: $key
+            ) {
+                donation {
+                    id
+                }
+            }
+        }
+        '''
+
+        self._client.force_login(self.me_person)
+
+        def donate(key):
+            result = json.loads(
+                self.query(
+                    query,
+                    op_name='DonationCreate',
+                    variables={
+                        'user': self.me_person.gid,
+                        'target': self.nonprofit.gid,
+                        'amount': 100,
+                        'key': key,
+                    },
+                ).content)
+            assert 'errors' not in result
+            return result['data']['createDonation']['donation']['id']
+
+        balance = self.me_person.balance()
+
+        assert donate('key_1') == donate('key_1')
+        assert self.me_person.balance() == balance - 100
+
+        assert donate('key_2') != donate('key_1')
+        assert self.me_person.balance() == balance - 200
+
+        models.IdempotencyKey.objects.update(
+            created=models.IdempotencyKey.expiration() - timedelta(hours=1))
+        assert donate('key_1') != donate('key_2')
+        assert self.me_person.balance() == balance - 400
+
+        # a replay while the original request is still in flight
+        models.IdempotencyKey.objects.create(
+            user=self.me_person,
+            operation=models.Donation.__name__,
+            key='key_3',
+        )
+        result = json.loads(
+            self.query(
+                query,
+                op_name='DonationCreate',
+                variables={
+                    'user': self.me_person.gid,
+                    'target': self.nonprofit.gid,
+                    'amount': 100,
+                    'key': 'key_3',
+                },
+            ).content)
+        assert result['errors'][0]['message'] == (
+            'Request is already in progress')
+        assert self.me_person.balance() == balance - 400
+
+    # paypal deposits are replayed by key, sent as a header or in the body
+    def test_payment_idempotency(self):
+        self._client.force_login(self.me_person)
+
+        def pay(key, header=False):
+            response = self._client.post(
+                '/ibis/payment/',
+                json.dumps({'orderID': 'order_' + key} if header else {
+                    'orderID': 'order_' + key,
+                    'idempotencyKey': key,
+                }),
+                content_type='application/json',
+                **({
+                    'HTTP_IDEMPOTENCY_KEY': key
+                } if header else {}),
+            )
+            return response.status_code, response.json()['depositID']
+
+        balance = self.me_person.balance()
+
+        with mock.patch.object(
+                PayPalClient,
+                'get_order',
+                side_effect=lambda order_id: (order_id, 1000, 30),
+        ) as get_order:
+            status, deposit = pay('key_1', header=True)
+            assert status == 200 and deposit
+            assert pay('key_1', header=True) == (200, deposit)
+            assert pay('key_1') == (200, deposit)
+            assert get_order.call_count == 1
+            assert self.me_person.balance() == balance + 1000
+
+            assert pay('key_2')[1] != deposit
+            assert self.me_person.balance() == balance + 2000
+
+            models.IdempotencyKey.objects.create(
+                user=self.me_person,
+                operation=models.Deposit.__name__,
+                key='key_3',
+            )
+            assert pay('key_3', header=True) == (409, '')
+            assert self.me_person.balance() == balance + 2000
+
+    # the reconciliation command reports corrupted balances
+    def test_reconcile(self):
+        # the fixtures do not come with ranked nonprofits
+        models.rank_nonprofits()
+
+        balance = self.me_person.balance()
+        models.Account.objects.filter(user_id=self.me_person.id).update(
+            balance=balance + 1)
+
+        out = StringIO()
+        with self.assertRaisesMessage(CommandError, 'Found 1 violation(s)'):
+            management.call_command('reconcile', chunk_size=7, stdout=out)
+        assert out.getvalue() == \
+            'Account {} has balance {} but transfers sum to {}\n'.format(
+                self.me_person.id, balance + 1, balance)
+
+        # reconciling only reports, so the account is still corrupted
+        assert models.Account.objects.get(
+            user_id=self.me_person.id).balance == balance + 1
+
+        models.rebuild_accounts()
+        out = StringIO()
+        management.call_command('reconcile', chunk_size=7, stdout=out)
+        assert out.getvalue() == 'No violations found\n'
+        assert models.Account.objects.get(
+            user_id=self.me_person.id).balance == balance
+
+    # nonprofit scores follow the materialized fundraised totals
+    def test_rank_nonprofits(self):
+        def ranked():
+            return list(
+                models.Nonprofit.objects.exclude(
+                    username=settings.IBIS_USERNAME_ROOT).order_by('score'))
+
+        models.rebuild_accounts()
+        models.rank_nonprofits()
+        last = ranked()[-1]
+        amount = ranked()[0].fundraised() - last.fundraised() + 1
+
+        # the donation re-ranks the nonprofits once its transaction commits
+        with run_on_commit():
+            models.Deposit.objects.create(
+                user=self.me_person,
+                amount=amount,
+                payment_id='unique_rank',
+                category=models.DepositCategory.objects.first(),
+            )
+            models.create_transfer(
+                models.Donation,
+                user=self.me_person,
+                target=last,
+                description='This is a donation',
+                amount=amount,
+            )
+            assert ranked()[-1] == last
+
+        assert models.rank_nonprofits() == 0
+
+        nonprofits = ranked()
+        assert nonprofits[0] == last
+        assert [x.score for x in nonprofits] == list(
+            range(1, len(nonprofits) + 1))
+        assert all(nonprofits[i].fundraised() >= nonprofits[i + 1].fundraised()
+                   for i in range(len(nonprofits) - 1))
+        assert all(x.fundraised() == models.calculate_fundraised([x.id])[x.id]
+                   for x in nonprofits)
+
+    # nonprofits can stream their own ledger and nobody else's
+    def test_export(self):
+        donation = models.Donation.objects.create(
+            user=self.me_person,
+            target=self.nonprofit,
+            amount=100,
+            description='Thanks @{}'.format(self.person.username),
+        )
+        models.Entry.objects.filter(pk=donation.pk).update(
+            rendered_description=None)
+
+        self._client.force_login(self.nonprofit)
+
+        response = self._client.get('/ibis/export/', {
+            'nonprofit': self.nonprofit.gid,
+        })
+        assert response.status_code == 200
+        rows = list(
+            csv.reader(
+                StringIO(b''.join(response.streaming_content).decode())))
+        assert len(rows) == 1 + models.Donation.objects.filter(
+            Q(user=self.nonprofit) | Q(target=self.nonprofit)).count(
+            ) + models.Withdrawal.objects.filter(user=self.nonprofit).count()
+
+        # mentions are exported as users see them, not as global ids
+        assert [
+            x[-1] for x in rows
+            if x[1] == to_global_id('DonationNode', donation.id)
+        ] == ['Thanks @{}'.format(self.person.username)]
+
+        response = self._client.get('/ibis/export/', {
+            'nonprofit': self.nonprofit.gid,
+            'output': 'jsonl',
+            'end': '2000-01-01',
+        })
+        assert response.status_code == 200
+        assert not b''.join(response.streaming_content)
+
+        self._client.force_login(self.me_person)
+        assert self._client.get('/ibis/export/', {
+            'nonprofit': self.nonprofit.gid,
+        }).status_code == 403
+
+
+class TransferConcurrencyTestCase(TransactionTestCase):
+    fixtures = BaseTestCase.fixtures
+
+    # hammer a single account from many threads; no double spending
+    def test_transfer_concurrent(self):
+        person = models.Person.objects.order_by('id').first()
+        targets = list(models.Person.objects.exclude(id=person.id)) + list(
+            models.Nonprofit.objects.all())
+
+        person.deposit_set.all().delete()
+        models.Donation.objects.filter(user=person).delete()
+        models.Transaction.objects.filter(user=person).delete()
+        models.Transaction.objects.filter(target=person).delete()
+
+        models.Deposit.objects.create(
+            user=person,
+            amount=NUM_THREADS * 50,
+            payment_id='unique_concurrent',
+            category=models.DepositCategory.objects.first(),
+        )
+
+        barrier = threading.Barrier(NUM_THREADS)
+        results = []
+
+        def transfer(target):
+            try:
+                barrier.wait()
+                models.create_transfer(
+                    models.Donation if isinstance(target, models.Nonprofit)
+                    else models.Transaction,
+                    user=person,
+                    target=target,
+                    amount=100,
+                    description='This is a description',
+                )
+                results.append(True)
+            except models.InsufficientBalance:
+                results.append(False)
+            finally:
+                connection.close()
+
+        threads = [
+            threading.Thread(target=transfer, args=(random.choice(targets), ))
+            for _ in range(NUM_THREADS)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(results) == NUM_THREADS
+        assert results.count(True) == NUM_THREADS / 2
+        assert person.balance() == 0
+        assert models.calculate_balances([person.id])[person.id] == 0
+        assert models.rebuild_accounts() == 0
@@ -4,7 +4,9 @@ import tracker.models
 import ibis.models as models
 
 from freezegun import freeze_time
+from django.db import connection
 from django.core.exceptions import ValidationError
+from django.test.utils import CaptureQueriesContext
 from django.utils.timezone import now, timedelta, utc
 from graphql_relay.node.node import to_global_id
 from api.test.base import BaseTestCase, TEST_TIME
@@ -829,3 +831,186 @@ class PermissionTestCase(BaseTestCase):
         )
 
         assert person2.username == 'jane_valid_2'
+
+        # taken suffixes are looked up in a single prefix query
+        for i in range(3, 12):
+            models.Person.objects.create(
+                username='jane_valid_{}'.format(i),
+                email='invalid@example.com',
+                first_name='Jane',
+                last_name='Valid',
+            )
+        with self.assertNumQueries(1):
+            assert models.generate_valid_username('Jane',
+                                                  'Valid') == 'jane_valid_12'
+
+    # trending scores only change for entries with new engagement
+    def test_trending(self):
+        models.update_trending()
+        assert models.update_trending() == 0
+        assert not models.Entry.objects.filter(trending_stale=True).exists()
+
+        scores = models.calculate_trending(
+            list(models.Entry.objects.values_list('id', flat=True)))
+        assert all(x.trending == scores[x.id]
+                   for x in models.Entry.objects.all())
+
+        post = models.Post.objects.first()
+        before = models.Entry.objects.get(id=post.id).trending
+        post.like.add(*models.IbisUser.objects.exclude(
+            id__in=post.like.all())[:2])
+        models.Comment.objects.create(
+            user=self.person,
+            parent=post,
+            description='This is a comment',
+        )
+
+        assert models.update_trending() == 2
+        assert models.Entry.objects.get(id=post.id).trending > before
+
+        # clearing from the user side flags every entry the user engaged with
+        user = post.like.first()
+        liked = set(user.likes.values_list('id', flat=True))
+        rsvped = set(user.rsvp_for_event.values_list('id', flat=True))
+        assert liked
+        user.likes.clear()
+        user.rsvp_for_event.clear()
+        assert set(
+            models.Entry.objects.filter(trending_stale=True).values_list(
+                'id', flat=True)) == liked | rsvped
+
+    def test_mentions(self):
+        post = models.Post.objects.first()
+        people = list(models.Person.objects.exclude(id=self.person.id))
+        assert len(people) > 2
+
+        def create(users):
+            with CaptureQueriesContext(connection) as context:
+                comment = models.Comment.objects.create(
+                    user=self.person,
+                    parent=post,
+                    description='Hello {} @not_a_user'.format(' '.join(
+                        '@{}'.format(x.username) for x in users)),
+                )
+            return comment, len(context)
+
+        create(people[:1])
+        _, few = create(people[:1])
+        comment, many = create(people)
+
+        # mentions are resolved in bulk regardless of their number
+        assert few == many
+        assert set(comment.mention.values_list('id', flat=True)) == set(
+            x.id for x in people)
+        assert comment.resolve_description() == 'Hello {} @not_a_user'.format(
+            ' '.join('@{}'.format(x.username) for x in people))
+
+        # edits keep the mentions still referenced by their global id
+        comment.description = comment.description.replace(
+            '@{}'.format(to_global_id('IbisUserNode', str(people[0].id))),
+            '',
+        )
+        comment.save()
+        assert set(comment.mention.values_list('id', flat=True)) == set(
+            x.id for x in people[1:])
+
+    def test_rendered_description(self):
+        people = list(models.Person.objects.exclude(id=self.person.id)[:2])
+        post = models.Post.objects.create(
+            user=self.person,
+            title='Title',
+            description='Hello @{} and @{}'.format(
+                *[x.username for x in people]),
+        )
+        assert post.rendered_description == 'Hello @{} and @{}'.format(
+            *[x.username for x in people])
+
+        # renaming a mentioned user invalidates the stored rendering
+        people[0].username = 'renamed_user'
+        people[0].save()
+        post.refresh_from_db()
+        assert post.rendered_description is None
+
+        models.Entry.objects.update(rendered_description=None)
+        entries = list(models.Entry.objects.all())
+        with CaptureQueriesContext(connection) as context:
+            models.render_descriptions(entries)
+        assert len(context) == 2
+
+        post.refresh_from_db()
+        assert post.resolve_description() == (
+            'Hello @renamed_user and @{}'.format(people[1].username))
+        assert not models.Entry.objects.filter(
+            rendered_description=None).exists()
+
+    def test_autocomplete(self):
+        person = models.Person.objects.exclude(id=self.person.id).first()
+        person.first_name = 'Autocomplete'
+        person.last_name = 'Tester'
+        person.save()
+        assert person.search_name == 'autocomplete tester'
+
+        others = [
+            models.Person.objects.create(
+                username='autocomplete_{}'.format(i),
+                email='autocomplete@example.com',
+                first_name='Other',
+                last_name='Person',
+            ) for i in range(3)
+        ]
+        self.person.following.add(others[2])
+
+        self._client.force_login(self.person)
+        result = json.loads(
+            self.query(
+                '''
+                query AutocompleteUsers($search: String!) {
+                    autocompleteUsers(search: $search) {
+                        username
+                    }
+                }
+                ''',
+                op_name='AutocompleteUsers',
+                variables={'search': '@AutoComplete'},
+            ).content)
+
+        # followed users come first, then matches by username or name
+        usernames = [
+            x['username'] for x in result['data']['autocompleteUsers']
+        ]
+        assert usernames[0] == others[2].username
+        assert set(usernames[1:]) == set(
+            [others[0].username, others[1].username, person.username])
+
+        # users stored without search names are filled in
+        models.IbisUser.objects.update(search_name='')
+        assert models.fill_search_names() == models.IbisUser.objects.exclude(
+            first_name='', last_name='').count()
+        person.refresh_from_db()
+        assert person.search_name == 'autocomplete tester'
+
+    def test_comment_threads(self):
+        post = models.Post.objects.first()
+        comments = [post]
+        for i in range(3):
+            comments.append(
+                models.Comment.objects.create(
+                    user=self.person,
+                    parent=comments[-1],
+                    description='Reply {}'.format(i),
+                ))
+
+        leaf = comments[-1]
+        assert leaf.root_id == post.id
+        assert leaf.depth == 3
+        assert leaf.get_ancestor_ids() == [x.id for x in comments[:-1]]
+        with self.assertNumQueries(1):
+            assert leaf.get_root().id == post.id
+        assert set(comments[1].get_descendants()) == set(comments[2:])
+
+        # comments stored without thread columns are filled in by level
+        count = models.Comment.objects.count()
+        models.Comment.objects.update(root=None, depth=0, path='')
+        assert models.fill_comment_threads() == count
+        leaf.refresh_from_db()
+        assert leaf.get_ancestor_ids() == [x.id for x in comments[:-1]]
@@ -3,3 +3,8 @@ from django.contrib import admin
 import distribution.models as models
 
 admin.site.register(models.Distributor)
+admin.site.register(models.Checkpoint)
+admin.site.register(models.WeeklyFlow)
+admin.site.register(models.Epoch)
+admin.site.register(models.DistributionRun)
+admin.site.register(models.Forecast)
@@ -0,0 +1,138 @@
+import bisect
+import itertools
+import ibis.models
+import distribution.models as models
+
+from collections import Counter
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils.timezone import localtime
+
+
+def _load_ubp(steps):
+    """Return the total UBP paid out in each of the given epochs"""
+
+    totals = [0] * len(steps)
+    if not steps:
+        return totals
+
+    for created, amount in ibis.models.Deposit.objects.filter(
+            category__title=settings.IBIS_CATEGORY_UBP,
+            created__gte=steps[0],
+            created__lt=models.to_step_start(steps[-1], offset=1),
+    ).order_by().values_list('created', 'amount').iterator():
+        totals[bisect.bisect_right(steps, created) - 1] += amount
+
+    return totals
+
+
+def simulate(history, ubp, kp, ti, td, elasticity):
+    """Replay the controller over the historical weeks. The effective
+    donations of each week are shifted by the elasticity times the
+    difference between the simulated and the historical UBP amount."""
+
+    error = []
+    amounts = []
+    for (goal, effective), paid in zip(history, ubp):
+        amount = models.compute_distribution_amount(error, goal, kp, ti, td)
+        error.append(effective + elasticity * (amount - paid) - goal)
+        amounts.append(amount)
+
+    return error, amounts
+
+
+class Command(BaseCommand):
+    help = 'Backtest distribution controller parameters on historical data'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--kp',
+            type=float,
+            nargs='+',
+            default=[settings.DISTRIBUTION_CONTROLLER_KP],
+        )
+        parser.add_argument(
+            '--ti',
+            type=float,
+            nargs='+',
+            default=[settings.DISTRIBUTION_CONTROLLER_TI],
+        )
+        parser.add_argument(
+            '--td',
+            type=float,
+            nargs='+',
+            default=[settings.DISTRIBUTION_CONTROLLER_TD],
+        )
+        parser.add_argument(
+            '--horizon',
+            type=int,
+            nargs='+',
+            default=[settings.DISTRIBUTION_HORIZON],
+        )
+        parser.add_argument('--elasticity', type=float, default=1.0)
+        parser.add_argument('--top', type=int, default=20)
+
+    def handle(self, *args, **options):
+        time = localtime()
+
+        # everything below runs in memory after these queries
+        history = models.get_control_history(time)
+        steps = [
+            models.to_step_start(x.created)
+            for x in models.Goal.objects.order_by('created')
+        ]
+        ubp = _load_ubp(steps)
+        activity = Counter(models.get_activity_weeks(time).values())
+
+        results = []
+        for kp, ti, td in itertools.product(
+                options['kp'],
+                options['ti'],
+                options['td'],
+        ):
+            error, amounts = simulate(
+                history,
+                ubp,
+                kp,
+                ti,
+                td,
+                options['elasticity'],
+            )
+            amount = models.compute_distribution_amount(
+                error, settings.DISTRIBUTION_GOAL, kp, ti, td)
+            mae = sum(abs(x) for x in error) / len(error) if error else 0
+            rmse = (sum(x**2 for x in error) / len(error))**0.5 if error else 0
+
+            for horizon in options['horizon']:
+                weights = {
+                    x: int(2**(horizon - x))
+                    for x in activity if int(2**(horizon - x))
+                }
+                total = sum(activity[x] * weights[x] for x in weights)
+                payouts = sorted(amount * weights[x] / total
+                                 for x in weights) if total else [0]
+
+                results.append([
+                    kp,
+                    ti,
+                    td,
+                    horizon,
+                    mae,
+                    rmse,
+                    amount,
+                    sum(activity[x] for x in weights),
+                    payouts[0],
+                    payouts[-1],
+                ])
+
+        self.stdout.write('{} week(s), {} scenario(s)'.format(
+            len(history), len(results)))
+        self.stdout.write(
+            '{:>6} {:>6} {:>6} {:>7} {:>10} {:>10} {:>10} {:>10} {:>8} {:>8}'.
+            format('kp', 'ti', 'td', 'horizon', 'mae', 'rmse', 'amount',
+                   'recipients', 'min', 'max'))
+
+        for x in sorted(results, key=lambda x: x[4])[:options['top']]:
+            self.stdout.write(
+                '{:>6.3f} {:>6.3f} {:>6.3f} {:>7} {:>10.0f} {:>10.0f} '
+                '{:>10.0f} {:>10} {:>8.0f} {:>8.0f}'.format(*x))
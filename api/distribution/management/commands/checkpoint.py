@@ -0,0 +1,36 @@
+import ibis.models
+import distribution.models as models
+
+from django.core.management.base import BaseCommand
+from django.db.models import Min
+from django.utils.timezone import localtime
+
+
+class Command(BaseCommand):
+    help = 'Record any missing weekly balance checkpoints'
+
+    def handle(self, *args, **options):
+        first = min(
+            [
+                x.objects.aggregate(Min('created'))['created__min']
+                for x in [
+                    ibis.models.Deposit,
+                    ibis.models.Withdrawal,
+                    ibis.models.Donation,
+                    ibis.models.Transaction,
+                ]
+            ],
+            key=lambda x: x or localtime(),
+            default=None,
+        )
+
+        if not first:
+            return
+
+        step = models.to_step_start(localtime(first), offset=1)
+        total = 0
+        while step <= localtime():
+            total += models.record_checkpoints(step)
+            step = models.to_step_start(step, offset=1)
+
+        self.stdout.write('Recorded {} checkpoint(s)'.format(total))
@@ -1,10 +1,22 @@
 import distribution.models as models
 
 from django.core.management.base import BaseCommand
+from django.utils.timezone import localtime
 
 
 class Command(BaseCommand):
     help = 'Safely distribute UBP'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk_size', type=int, default=None)
+        parser.add_argument('--processes', type=int, default=1)
+
     def handle(self, *args, **options):
-        models.distribute_all_safe()
+        timings = models.distribute_all_safe(
+            chunk_size=options['chunk_size'],
+            processes=options['processes'],
+        )
+        for stage in timings or {}:
+            self.stdout.write('{}: {:.3f}s'.format(stage, timings[stage]))
+        models.settle_recurring_safe(localtime())
+        models.refresh_forecast(localtime())
@@ -0,0 +1,16 @@
+import distribution.models as models
+
+from django.core.management.base import BaseCommand
+from django.utils.timezone import localtime
+
+
+class Command(BaseCommand):
+    help = 'Precompute the forecast of the next distribution'
+
+    def handle(self, *args, **options):
+        forecast = models.refresh_forecast(localtime())
+        self.stdout.write('Forecast {:.2f} for {} recipient(s) on {}'.format(
+            forecast.amount / 100,
+            forecast.recipients,
+            forecast.step.date(),
+        ))
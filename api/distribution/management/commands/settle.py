@@ -0,0 +1,13 @@
+import distribution.models as models
+
+from django.core.management.base import BaseCommand
+from django.utils.timezone import localtime
+
+
+class Command(BaseCommand):
+    help = 'Safely settle recurring donations'
+
+    def handle(self, *args, **options):
+        donations = models.settle_recurring_safe(localtime())
+        self.stdout.write('Settled {} recurring donation(s)'.format(
+            len(donations)))
@@ -1,9 +1,12 @@
 import random
+import multiprocessing
 
 from hashlib import sha256
+from timeit import default_timer as timer
 
-from django.db import models
-from django.db.models import Q
+from django.db import models, transaction, connections
+from django.db.models import F, Q, Max, Sum
+from django.db.models.functions import Coalesce
 from django.conf import settings
 from django.utils.timezone import datetime, localtime, timedelta
 from model_utils.models import TimeStampedModel
@@ -22,28 +25,190 @@ DAYS = (
 )
 
 
-def distribute_all_safe():
+def distribute_all_safe(chunk_size=None, processes=1):
     """Calculate UBP global amount and personal shares and safely
     distribute deposits. The function is *safe* because it has no effect
     if called more than once within the same (weekly) time epoch.
+
+    People are paid in chunks ordered by id, each in its own transaction,
+    and a DistributionRun records the amount and the last finished chunk,
+    so an interrupted run resumes where it stopped. With more than one
+    process, chunks are spread over a pool of workers with their own
+    database connections. Returns the time spent in each stage or None if
+    the epoch was already done.
     """
 
-    time = localtime()
+    chunk_size = chunk_size or settings.DISTRIBUTION_CHUNK_SIZE
+    step = to_step_start(localtime())
 
-    if Goal.objects.filter(created__gte=to_step_start(time)).exists():
+    if Goal.objects.filter(created__gte=step).exists():
         return
 
-    amount = get_distribution_amount(time)
-    shares = get_distribution_shares(time)
+    timings = {}
+    start = timer()
 
-    for person in shares:
-        person.distributor.distribute_safe(time,
-                                           round(amount * shares[person]))
+    def stage(name):
+        nonlocal start
+        timings[name] = timer() - start
+        start = timer()
 
-    Goal.objects.create(
-        amount=settings.DISTRIBUTION_GOAL,
-        created=time,
-    )
+    run = DistributionRun.objects.filter(step=step).first()
+
+    if not run:
+        time = localtime()
+        record_checkpoints(step)
+        stage('checkpoints')
+
+        run = DistributionRun.objects.get_or_create(
+            step=step,
+            defaults={
+                'created': time,
+                'amount': get_distribution_amount(time),
+            },
+        )[0]
+        stage('amount')
+
+    time = localtime(run.created)
+    payouts = get_distribution_payouts(time, run.amount)
+    chunks = [
+        (time, x)
+        for x in chunked(
+            sorted((x.id, payouts[x]) for x in payouts if x.id > run.cursor),
+            chunk_size)
+    ]
+    stage('payouts')
+
+    if processes > 1 and len(chunks) > 1:
+        # forked workers must not share the parent's connection
+        connections.close_all()
+        with multiprocessing.Pool(processes, connections.close_all) as pool:
+            for cursor in pool.imap(distribute_chunk_safe, chunks):
+                run.advance(cursor)
+    else:
+        for chunk in chunks:
+            run.advance(distribute_chunk_safe(chunk))
+    stage('deposits')
+
+    with transaction.atomic():
+        Goal.objects.create(
+            amount=settings.DISTRIBUTION_GOAL,
+            created=time,
+        )
+        Epoch.objects.filter(step=step).delete()
+        DistributionRun.objects.filter(pk=run.pk).update(completed=localtime())
+
+    return timings
+
+
+def chunked(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def distribute_chunk_safe(chunk):
+    """Pay one chunk of (person id, amount) payouts of a distribution run
+    and return the last person id of the chunk"""
+
+    time, payouts = chunk
+    people = ibis.models.Person.objects.only('id').in_bulk(
+        [x for x, _ in payouts])
+    distribute_payouts_safe(
+        time, {people[x]: amount
+               for x, amount in payouts if x in people})
+
+    return payouts[-1][0]
+
+
+def distribute_payouts_safe(time, payouts):
+    """Create the UBP deposits for a dictionary of person -> amount in
+    chunks of bulk inserts along with their notifications and emails. The
+    function is *safe* because people who already received a UBP deposit
+    in the current (weekly) time epoch are skipped.
+    """
+
+    category = ibis.models.get_deposit_category(settings.IBIS_CATEGORY_UBP)
+
+    with transaction.atomic():
+        paid = set(
+            ibis.models.Deposit.objects.filter(
+                category=category,
+                created__gte=to_step_start(time),
+                user_id__in=[x.id for x in payouts],
+            ).values_list('user_id', flat=True))
+
+        deposits = [
+            ibis.models.Deposit(
+                user=person,
+                amount=payouts[person],
+                payment_id='ubp:{}'.format(
+                    sha256(str(random.random()).encode('utf-8')).hexdigest()),
+                category=category,
+                created=time,
+            ) for person in sorted(payouts, key=lambda x: x.id)
+            if person.id not in paid
+        ]
+
+        ibis.models.Account.create_missing([x.user_id for x in deposits])
+
+        for chunk in chunked(deposits, settings.DISTRIBUTION_CHUNK_SIZE):
+            ibis.models.Account.lock([x.user_id for x in chunk])
+            ibis.models.insert_transfers(chunk)
+
+    return deposits
+
+
+def settle_recurring_safe(time):
+    """Create this week's donations for all active recurring donations in
+    one pass. Pledges are settled in order of creation against a single
+    locked read of the balances involved and pledges that the user cannot
+    afford are skipped for the week. The function is *safe* because each
+    pledge is settled at most once per (weekly) time epoch.
+    """
+
+    step = to_step_start(time)
+
+    with transaction.atomic():
+        pledges = list(
+            ibis.models.RecurringDonation.objects.select_for_update().filter(
+                active=True).exclude(last_settled__gte=step).select_related(
+                    'user', 'target').order_by('created', 'id'))
+
+        if not pledges:
+            return []
+
+        # mentions are parsed like those of any donation, before the locks
+        prepared = [
+            ibis.models.prepare_transfer({
+                'user': x.user,
+                'target': x.target,
+                'amount': x.amount,
+                'description': x.description,
+                'private': x.private,
+                'created': time,
+            }) for x in pledges
+        ]
+
+        user_ids = set([x.user_id for x in pledges] +
+                       [x.target_id for x in pledges])
+        ibis.models.Account.create_missing(user_ids)
+        balances = ibis.models.Account.lock(user_ids)
+
+        donations = []
+        mentions = []
+        for pledge, (kwargs, mention) in zip(pledges, prepared):
+            if balances[pledge.user_id] < pledge.amount:
+                continue
+            balances[pledge.user_id] -= pledge.amount
+            balances[pledge.target_id] += pledge.amount
+            donations.append(ibis.models.Donation(**kwargs))
+            mentions.append(mention)
+
+        ibis.models.insert_transfers(donations)
+
+        ibis.models.RecurringDonation.objects.filter(
+            id__in=[x.id for x in pledges]).update(last_settled=time)
+
+    ibis.models.add_transfer_mentions(donations, mentions)
+    return donations
 
 
 def get_distribution_amount(time):
@@ -52,26 +217,38 @@ def get_distribution_amount(time):
     deviation of effective weekly donations from the specified goal
     and the control signal is the weekly UBP amount. """
 
-    error = [x[1] - x[0] for x in get_control_history(time)]
+    return compute_distribution_amount(
+        [x[1] - x[0] for x in get_control_history(time)],
+        settings.DISTRIBUTION_GOAL,
+        settings.DISTRIBUTION_CONTROLLER_KP,
+        settings.DISTRIBUTION_CONTROLLER_TI,
+        settings.DISTRIBUTION_CONTROLLER_TD,
+    )
+
+
+def compute_distribution_amount(error, goal, kp, ti, td):
+    """Calculate the UBP amount from the control error timeseries with the
+    given controller parameters. Has no database access, so it can be
+    replayed for alternative parameters."""
 
     # Let settle for first three weeks
     if len(error) < 3:
-        return settings.DISTRIBUTION_GOAL
+        return goal
 
     # PID controller
-    control = settings.DISTRIBUTION_CONTROLLER_KP * sum([
+    control = kp * sum([
         error[-1],
-        (1 / settings.DISTRIBUTION_CONTROLLER_TI) * sum(error),
-        settings.DISTRIBUTION_CONTROLLER_TD * (error[-1] - error[-2]),
+        (1 / ti) * sum(error),
+        td * (error[-1] - error[-2]),
     ])
 
     # Impose max/min thresholds
-    if control < -0.5 * settings.DISTRIBUTION_GOAL:
-        control = -0.5 * settings.DISTRIBUTION_GOAL
-    elif control > 0.5 * settings.DISTRIBUTION_GOAL:
-        control = 0.5 * settings.DISTRIBUTION_GOAL
+    if control < -0.5 * goal:
+        control = -0.5 * goal
+    elif control > 0.5 * goal:
+        control = 0.5 * goal
 
-    return settings.DISTRIBUTION_GOAL - control
+    return goal - control
 
 
 def get_control_history(time):
@@ -88,62 +265,219 @@ def get_control_history(time):
                for i in range(len(goals) - 1)):
         raise ValueError('Non-contiguous or duplicate goal objects')
 
-    return [
-        [
-            x.amount,
-            sum([
-                sum(  # sum of all donations
-                    x.amount for x in ibis.models.Donation.objects.filter(
-                        created__gte=to_step_start(x.created),
-                        created__lt=to_step_start(x.created, offset=1))),
-                -sum(  # sum of non-UBP deposits
-                    x.amount for x in ibis.models.Deposit.objects.exclude(
-                        category=ibis.models.DepositCategory.
-                        objects.get(title=settings.IBIS_CATEGORY_UBP)).filter(
-                            created__gte=to_step_start(x.created),
-                            created__lt=to_step_start(x.created, offset=1))),
-                -sum(  # sum of outbound donations
-                    x.amount for x in ibis.models.Donation.objects.filter(
-                        user__nonprofit__isnull=False,
-                        created__gte=to_step_start(x.created),
-                        created__lt=to_step_start(x.created, offset=1))),
-                -sum(  # sum of outbound transactions
-                    x.amount for x in ibis.models.Transaction.objects.filter(
-                        user__nonprofit__isnull=False,
-                        created__gte=to_step_start(x.created),
-                        created__lt=to_step_start(x.created, offset=1))),
-            ]),
-        ] for x in goals
-    ]
+    steps = [to_step_start(x.created) for x in goals]
+    flows = {x.step: x for x in WeeklyFlow.objects.filter(step__in=steps)}
 
+    return [[
+        x.amount,
+        (flows.get(step) or WeeklyFlow.calculate(step)).effective(),
+    ] for x, step in zip(goals, steps)]
 
-def get_distribution_shares(time, initial=[]):
-    """Calculate the relative UBP share for each active person based on the
-    recency of their last activity (donation or transaction).
+
+def get_activity_weeks(time):
+    """Calculate the number of weeks since the last activity (donation or
+    transaction) of each eligible person. The last activity of every
+    person is read with a single grouped query.
     """
 
     step = to_step_start(time)
 
-    # calculate raw relative shares
-    raw = {}
-    for x in ibis.models.Person.objects.exclude(distributor__eligible=False):
-        activity = x.entry_set.filter(
-            Q(donation__isnull=False)
-            | Q(transaction__isnull=False)).filter(
-                created__lt=step).order_by('created').last()
-        last = to_step_start(
-            localtime(activity.created) if activity else to_step_start(
-                x.date_joined, offset=-1))
-        weeks = (step.date() - last.date()).days / len(DAYS)
-        raw[x] = int(2**(settings.DISTRIBUTION_HORIZON - weeks))
+    activity = dict(
+        ibis.models.Entry.objects.filter(
+            Q(donation__isnull=False) | Q(transaction__isnull=False),
+            created__lt=step,
+        ).order_by().values_list('user_id').annotate(last=Max('created')))
+
+    return {
+        x: _weeks_since(step, activity.get(x.id), x.date_joined)
+        for x in ibis.models.Person.objects.exclude(
+            distributor__eligible=False).filter(
+                date_joined__lte=time).only('id', 'date_joined')
+    }
+
+
+def _weeks_since(step, activity, date_joined):
+    last = to_step_start(
+        localtime(activity) if activity else to_step_start(
+            date_joined, offset=-1))
+    return (step.date() - last.date()).days / len(DAYS)
+
+
+def get_distribution_weights(time, initial=[]):
+    """Calculate the raw integer UBP weight for each active person based on
+    the recency of their last activity (donation or transaction).
+    """
+
+    weeks = get_activity_weeks(time)
+    raw = {
+        x: int(2**(settings.DISTRIBUTION_HORIZON - weeks[x]))
+        for x in weeks
+    }
 
     for x in initial:
         if x.distributor.eligible:
             raw[x] = 2**(settings.DISTRIBUTION_HORIZON - 1)
 
-    # prune and normalize
+    return {x: raw[x] for x in raw if raw[x]}
+
+
+def get_distribution_shares(time, initial=[]):
+    """Calculate the relative UBP share for each active person based on the
+    recency of their last activity (donation or transaction).
+    """
+
+    raw = get_distribution_weights(time, initial=initial)
+
+    # normalize
+    total = sum(raw.values())
+    return {x: raw[x] / total for x in raw} if total else {}
+
+
+def get_distribution_payouts(time, amount):
+    """Split the global UBP amount into whole-cent payouts proportional to
+    each person's weight. Payouts are rounded down and the leftover cents
+    go one at a time to the people with the largest remainders, ties broken
+    by id, so the payouts add up to the amount exactly and people with the
+    same weight differ by at most a cent.
+    """
+
+    raw = get_distribution_weights(time)
     total = sum(raw.values())
-    return {x: raw[x] / total for x in raw if raw[x]} if total else {}
+    if not total:
+        return {}
+
+    amount = int(round(amount))
+
+    payouts = {x: amount * raw[x] // total for x in raw}
+    leftover = amount - sum(payouts.values())
+
+    for x in sorted(raw, key=lambda x:
+                    (-(amount * raw[x] % total), x.id))[:leftover]:
+        payouts[x] += 1
+
+    return payouts
+
+
+def refresh_forecast(time):
+    """Precompute the forecast of the next distribution: the expected
+    amount and every person's share weight as of the start of the next
+    epoch. Forecasts of earlier epochs are discarded.
+    """
+
+    step = to_step_start(time, offset=1)
+    weights = get_distribution_weights(step)
+
+    with transaction.atomic():
+        Forecast.objects.filter(step__lte=step).delete()
+        forecast = Forecast.objects.create(
+            step=step,
+            amount=get_distribution_amount(time),
+            weight=sum(weights.values()),
+            recipients=len(weights),
+        )
+        ForecastShare.objects.bulk_create(
+            [
+                ForecastShare(forecast=forecast, person=x, weight=weights[x])
+                for x in weights
+            ],
+            batch_size=settings.DISTRIBUTION_CHUNK_SIZE,
+        )
+
+    return forecast
+
+
+def update_forecast_share(person, time):
+    """Recalculate the share weight of a single person in the current
+    forecast and adjust the forecast totals by the difference. Has no
+    effect if no forecast was precomputed for the next epoch.
+    """
+
+    forecast = Forecast.objects.filter(
+        step=to_step_start(time, offset=1)).first()
+    if not forecast:
+        return
+
+    weight = 0
+    if person.distributor.eligible and person.date_joined <= forecast.step:
+        activity = person.entry_set.filter(
+            Q(donation__isnull=False) | Q(transaction__isnull=False),
+            created__lt=forecast.step,
+        ).aggregate(Max('created'))['created__max']
+        weight = int(2**(settings.DISTRIBUTION_HORIZON - _weeks_since(
+            forecast.step, activity, person.date_joined)))
+
+    share = forecast.shares.filter(person=person).first()
+    previous = share.weight if share else 0
+    if weight == previous:
+        return
+
+    with transaction.atomic():
+        if not weight:
+            share.delete()
+        elif share:
+            ForecastShare.objects.filter(pk=share.pk).update(weight=weight)
+        else:
+            ForecastShare.objects.create(
+                forecast=forecast,
+                person=person,
+                weight=weight,
+            )
+
+        Forecast.objects.filter(pk=forecast.pk).update(
+            weight=F('weight') + weight - previous,
+            recipients=F('recipients') + int(bool(weight)) -
+            int(bool(previous)),
+        )
+
+
+def record_checkpoints(step):
+    """Record the balance of every user whose balance changed since the
+    previous checkpoint epoch as of the start of the given epoch. Users
+    without a new checkpoint keep the balance of their latest one, so
+    each epoch only costs one grouped query per transfer type. The
+    function has no effect if the epoch has already been recorded.
+    """
+
+    if Checkpoint.objects.filter(step=step).exists():
+        return 0
+
+    previous = Checkpoint.objects.filter(step__lt=step).aggregate(
+        Max('step'))['step__max']
+    changes = ibis.models.calculate_balance_changes(previous, step)
+
+    balances = dict(
+        Checkpoint.objects.filter(
+            user_id__in=changes.keys(),
+            step__lt=step,
+        ).order_by('user_id', '-step').distinct('user_id').values_list(
+            'user_id', 'balance'))
+
+    Checkpoint.objects.bulk_create([
+        Checkpoint(
+            user_id=user_id,
+            step=step,
+            balance=balances.get(user_id, 0) + changes[user_id],
+        ) for user_id in changes
+    ])
+
+    return len(changes)
+
+
+def get_historical_balance(user, time):
+    """Calculate the balance of the user at the specified time as the
+    nearest preceding checkpoint plus the transfers made since then
+    """
+
+    checkpoint = Checkpoint.objects.filter(
+        user=user,
+        step__lte=time,
+    ).order_by('step').last()
+
+    if checkpoint:
+        return checkpoint.balance + ibis.models.calculate_balances(
+            [user.id], start=checkpoint.step, end=time)[user.id]
+
+    return ibis.models.calculate_balances([user.id], end=time)[user.id]
 
 
 def to_step_start(time, offset=0):
@@ -165,6 +499,182 @@ class Goal(TimeStampedModel):
     amount = models.PositiveIntegerField()
 
 
+class DistributionRun(models.Model):
+    step = models.DateTimeField(unique=True)
+    created = models.DateTimeField()
+    amount = models.FloatField()
+    cursor = models.IntegerField(default=0)
+    completed = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return '{}:{}'.format(self.step.date(), self.cursor)
+
+    def advance(self, cursor):
+        self.cursor = cursor
+        DistributionRun.objects.filter(pk=self.pk).update(cursor=cursor)
+
+
+class Forecast(models.Model):
+    step = models.DateTimeField(unique=True)
+    amount = models.FloatField()
+    weight = models.BigIntegerField()
+    recipients = models.PositiveIntegerField()
+
+    def __str__(self):
+        return '{}:{}'.format(self.step.date(), self.amount)
+
+    def payout(self, weight):
+        if not self.weight:
+            return 0
+        return int(round(self.amount)) * weight // self.weight
+
+    @classmethod
+    def get_payout(cls, person, time):
+        """Return the forecasted UBP payout of the person in the next
+        distribution or None if no forecast is available"""
+
+        forecast = cls.objects.filter(
+            step=to_step_start(time, offset=1)).first()
+        if not forecast:
+            return None
+
+        share = forecast.shares.filter(person=person).first()
+        return forecast.payout(share.weight) if share else 0
+
+
+class ForecastShare(models.Model):
+    class Meta:
+        unique_together = [['forecast', 'person']]
+
+    forecast = models.ForeignKey(
+        Forecast,
+        related_name='shares',
+        on_delete=models.CASCADE,
+    )
+    person = models.ForeignKey(
+        ibis.models.Person,
+        on_delete=models.CASCADE,
+    )
+    weight = models.PositiveIntegerField()
+
+    def __str__(self):
+        return '{}:{}'.format(self.forecast, self.person)
+
+
+class Checkpoint(models.Model):
+    class Meta:
+        unique_together = [['user', 'step']]
+
+    user = models.ForeignKey(
+        ibis.models.IbisUser,
+        on_delete=models.CASCADE,
+    )
+    step = models.DateTimeField(db_index=True)
+    balance = models.IntegerField()
+
+    def __str__(self):
+        return '{}:{}'.format(self.user, self.step.date())
+
+
+class WeeklyFlow(models.Model):
+    """Rollup of the transfer totals that drive the distribution controller
+    for a single epoch. Rows are only stored for closed epochs, so each
+    epoch is scanned once and dropped again if a transfer is backdated
+    into it.
+    """
+
+    step = models.DateTimeField(unique=True)
+    donated = models.BigIntegerField(default=0)
+    deposited = models.BigIntegerField(default=0)
+    nonprofit_donated = models.BigIntegerField(default=0)
+    nonprofit_transacted = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return '{}:{}'.format(self.step.date(), self.effective())
+
+    def effective(self):
+        return self.donated - self.deposited - self.nonprofit_donated - \
+            self.nonprofit_transacted
+
+    @classmethod
+    def calculate(cls, step):
+        end = to_step_start(step, offset=1)
+
+        def total(queryset):
+            return queryset.filter(
+                created__gte=step,
+                created__lt=end,
+            ).aggregate(total=Coalesce(Sum('amount'), 0))['total']
+
+        values = {
+            'donated':
+            total(ibis.models.Donation.objects.all()),
+            'deposited':
+            total(
+                ibis.models.Deposit.objects.exclude(
+                    category=ibis.models.get_deposit_category(
+                        settings.IBIS_CATEGORY_UBP))),
+            'nonprofit_donated':
+            total(
+                ibis.models.Donation.objects.filter(
+                    user__nonprofit__isnull=False)),
+            'nonprofit_transacted':
+            total(
+                ibis.models.Transaction.objects.filter(
+                    user__nonprofit__isnull=False)),
+        }
+
+        if end > localtime():
+            return cls(step=step, **values)
+
+        return cls.objects.get_or_create(step=step, defaults=values)[0]
+
+
+class Epoch(models.Model):
+    """Cache of the distribution amount, the total share weight and the
+    number of UBP deposits of an epoch, so that initial payouts to new
+    people do not recompute them. Initial payouts update the row in place
+    and it is dropped whenever the underlying data changes.
+    """
+
+    step = models.DateTimeField(unique=True)
+    amount = models.FloatField()
+    weight = models.BigIntegerField()
+    recipients = models.PositiveIntegerField()
+    deposits = models.PositiveIntegerField()
+
+    def __str__(self):
+        return '{}:{}'.format(self.step.date(), self.amount)
+
+    @classmethod
+    def load(cls, time, exclude=None):
+        step = to_step_start(time)
+
+        epoch = cls.objects.filter(step=step).first()
+        if epoch:
+            return epoch
+
+        weights = get_distribution_weights(time)
+        weights.pop(exclude, None)
+
+        return cls.objects.get_or_create(
+            step=step,
+            defaults={
+                'amount':
+                get_distribution_amount(time),
+                'weight':
+                sum(weights.values()),
+                'recipients':
+                len(weights),
+                'deposits':
+                ibis.models.Deposit.objects.filter(
+                    created__gte=step,
+                    category__title=settings.IBIS_CATEGORY_UBP,
+                ).exclude(user=exclude).count(),
+            },
+        )[0]
+
+
 class Distributor(models.Model):
     person = AutoOneToOneField(
         ibis.models.Person,
@@ -181,16 +691,16 @@ class Distributor(models.Model):
         """
         if self.eligible and not self.person.deposit_set.filter(
                 created__gte=to_step_start(time),
-                category=ibis.models.DepositCategory.objects.get(
-                    title=settings.IBIS_CATEGORY_UBP),
+                category=ibis.models.get_deposit_category(
+                    settings.IBIS_CATEGORY_UBP),
         ).exists():
             ibis.models.Deposit.objects.create(
                 user=self.person,
                 amount=amount,
                 payment_id='ubp:{}'.format(
                     sha256(str(random.random()).encode('utf-8')).hexdigest()),
-                category=ibis.models.DepositCategory.objects.get(
-                    title=settings.IBIS_CATEGORY_UBP),
+                category=ibis.models.get_deposit_category(
+                    settings.IBIS_CATEGORY_UBP),
                 created=time,
             )
 
@@ -203,8 +713,8 @@ class Distributor(models.Model):
         """
 
         if self.person.deposit_set.filter(
-                category=ibis.models.DepositCategory.objects.get(
-                    title=settings.IBIS_CATEGORY_UBP)).exists():
+                category=ibis.models.get_deposit_category(
+                    settings.IBIS_CATEGORY_UBP)).exists():
             return
 
         time = localtime()
@@ -214,17 +724,23 @@ class Distributor(models.Model):
                 time,
                 amount=settings.DISTRIBUTION_INITIAL,
             )
-        else:
-            total = get_distribution_amount(time)
-            shares = get_distribution_shares(time, initial=[self.person])
-            population_discount = len(shares) / (
-                ibis.models.Deposit.objects.filter(
-                    created__gte=to_step_start(time),
-                    category=ibis.models.DepositCategory.objects.get(
-                        title=settings.IBIS_CATEGORY_UBP),
-                ).count() + 1)
-
-            self.distribute_safe(
-                time,
-                amount=total * shares[self.person] * population_discount,
-            )
+        elif self.eligible:
+            weight = 2**(settings.DISTRIBUTION_HORIZON - 1)
+
+            with transaction.atomic():
+                epoch = Epoch.load(time, exclude=self.person)
+                population_discount = (epoch.recipients + 1) / (
+                    epoch.deposits + 1)
+
+                self.distribute_safe(
+                    time,
+                    amount=round(epoch.amount * weight /
+                                 (epoch.weight + weight) *
+                                 population_discount),
+                )
+
+                Epoch.objects.filter(pk=epoch.pk).update(
+                    weight=F('weight') + weight,
+                    recipients=F('recipients') + 1,
+                    deposits=F('deposits') + 1,
+                )
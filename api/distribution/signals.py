@@ -1,7 +1,10 @@
 import ibis.models
+import distribution.models as models
 
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
+from django.utils.timezone import localtime
 from api.management.commands.loaddata import STATE
 
 
@@ -11,3 +14,75 @@ def handlePersonCreate(sender, instance, created, raw, **kwargs):
         return
 
     instance.distributor.distribute_initial_safe()
+
+
+@receiver(post_save, sender=models.Distributor)
+def handleDistributorUpdate(sender, instance, created, raw, **kwargs):
+    # eligibility changes the share weights of the current epoch
+    if not created:
+        models.Epoch.objects.filter(
+            step=models.to_step_start(localtime())).delete()
+        models.update_forecast_share(instance.person, localtime())
+
+
+def _update_forecast(user_ids):
+    # a person's share only changes with the first activity of the week;
+    # deferred so that transfers never update the forecast under their locks
+    def update():
+        for person in ibis.models.Person.objects.filter(id__in=user_ids):
+            models.update_forecast_share(person, localtime())
+
+    transaction.on_commit(update)
+
+
+@receiver(post_save, sender=ibis.models.Person)
+def handleForecastPerson(sender, instance, created, raw, **kwargs):
+    if STATE['LOADING_DATA'] or raw or not created:
+        return
+
+    _update_forecast([instance.id])
+
+
+@receiver(post_save, sender=ibis.models.Donation)
+@receiver(post_save, sender=ibis.models.Transaction)
+def handleForecastTransfer(sender, instance, created, raw, **kwargs):
+    if STATE['LOADING_DATA'] or raw or not created:
+        return
+
+    _update_forecast([instance.user_id])
+
+
+@receiver(ibis.models.transfers_created, sender=ibis.models.Donation)
+@receiver(ibis.models.transfers_created, sender=ibis.models.Transaction)
+def handleForecastTransfers(sender, instances, **kwargs):
+    _update_forecast(set(x.user_id for x in instances))
+
+
+@receiver(post_save, sender=ibis.models.Deposit)
+@receiver(post_save, sender=ibis.models.Withdrawal)
+@receiver(post_save, sender=ibis.models.Donation)
+@receiver(post_save, sender=ibis.models.Transaction)
+@receiver(post_delete, sender=ibis.models.Deposit)
+@receiver(post_delete, sender=ibis.models.Withdrawal)
+@receiver(post_delete, sender=ibis.models.Donation)
+@receiver(post_delete, sender=ibis.models.Transaction)
+def handleTransferBackdate(sender, instance, **kwargs):
+    # checkpoints after a backdated change are stale; historical lookups
+    # fall back to the earlier checkpoints until they are recorded again
+    if instance.created < models.to_step_start(localtime()):
+        models.Checkpoint.objects.filter(step__gt=instance.created).delete()
+        models.Epoch.objects.filter(step__gt=instance.created).delete()
+
+
+@receiver(post_save, sender=ibis.models.Deposit)
+@receiver(post_save, sender=ibis.models.Donation)
+@receiver(post_save, sender=ibis.models.Transaction)
+@receiver(post_delete, sender=ibis.models.Deposit)
+@receiver(post_delete, sender=ibis.models.Donation)
+@receiver(post_delete, sender=ibis.models.Transaction)
+def handleTransferFlow(sender, instance, **kwargs):
+    # only closed epochs are rolled up, so new transfers never touch them
+    flow = models.WeeklyFlow.objects.filter(
+        step__lte=instance.created).order_by('-step').first()
+    if flow and instance.created < models.to_step_start(flow.step, offset=1):
+        flow.delete()
@@ -46,9 +46,12 @@ admin.site.register(models.Event, EntryNonprofitAdmin)
 
 admin.site.register(models.NonprofitCategory)
 admin.site.register(models.DepositCategory)
+admin.site.register(models.Account)
+admin.site.register(models.IdempotencyKey)
 admin.site.register(models.Deposit)
 admin.site.register(models.Withdrawal)
 admin.site.register(models.Entry)
 admin.site.register(models.Donation)
+admin.site.register(models.RecurringDonation)
 admin.site.register(models.Transaction)
 admin.site.register(models.Comment)
@@ -0,0 +1,12 @@
+import ibis.models as models
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Delete idempotency keys older than IDEMPOTENCY_KEY_TTL'
+
+    def handle(self, *args, **options):
+        count, _ = models.IdempotencyKey.objects.filter(
+            created__lt=models.IdempotencyKey.expiration()).delete()
+        self.stdout.write('Deleted {} expired key(s)'.format(count))
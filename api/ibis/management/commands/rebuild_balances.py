@@ -0,0 +1,11 @@
+import ibis.models as models
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Rebuild materialized account balances from the transfer tables'
+
+    def handle(self, *args, **options):
+        count = models.rebuild_accounts()
+        self.stdout.write('Rebuilt {} account balance(s)'.format(count))
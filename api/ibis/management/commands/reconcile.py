@@ -0,0 +1,114 @@
+import itertools
+from collections import defaultdict
+import ibis.models as models
+import distribution.models
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import localtime
+
+
+def _batches(queryset, chunk_size):
+    # .iterator() uses a server-side cursor on postgres
+    rows = queryset.iterator(chunk_size=chunk_size)
+    while True:
+        batch = list(itertools.islice(rows, chunk_size))
+        if not batch:
+            return
+        yield batch
+
+
+class Command(BaseCommand):
+    help = 'Check ledger invariants by streaming the transfer tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk_size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        violations = 0
+
+        def report(message):
+            nonlocal violations
+            violations += 1
+            self.stdout.write(message)
+
+        # --- balances --- #
+
+        balances = defaultdict(int)
+        fundraised = defaultdict(int)
+
+        for model, field, sign in [
+            (models.Deposit, 'user', +1),
+            (models.Withdrawal, 'user', -1),
+            (models.Donation, 'user', -1),
+            (models.Donation, 'target', +1),
+            (models.Transaction, 'user', -1),
+            (models.Transaction, 'target', +1),
+        ]:
+            queryset = model.objects.order_by().values_list(
+                '{}_id'.format(field), 'amount')
+            for batch in _batches(queryset, chunk_size):
+                for user_id, amount in batch:
+                    balances[user_id] += sign * amount
+                if model == models.Donation and field == 'target':
+                    for user_id, amount in batch:
+                        fundraised[user_id] += amount
+
+        for user_id, balance in list(balances.items()):
+            if balance < 0:
+                report('User {} has negative balance {}'.format(
+                    user_id, balance))
+
+        queryset = models.Account.objects.order_by().values_list(
+            'user_id', 'balance', 'fundraised')
+        for batch in _batches(queryset, chunk_size):
+            for user_id, balance, total in batch:
+                if balance != balances[user_id]:
+                    report(
+                        'Account {} has balance {} but transfers sum to {}'.
+                        format(user_id, balance, balances[user_id]))
+                if total != fundraised[user_id]:
+                    report(
+                        'Account {} has fundraised {} but donations sum to {}'
+                        .format(user_id, total, fundraised[user_id]))
+
+        # --- UBP --- #
+
+        queryset = models.Deposit.objects.filter(
+            category__title=settings.IBIS_CATEGORY_UBP).order_by(
+                'user_id', 'created').values_list('user_id', 'created')
+
+        previous = None
+        for batch in _batches(queryset, chunk_size):
+            for user_id, created in batch:
+                epoch = (user_id,
+                         distribution.models.to_step_start(localtime(created)))
+                if epoch == previous:
+                    report(
+                        'User {} has multiple UBP deposits in epoch {}'.format(
+                            user_id, epoch[1].date()))
+                previous = epoch
+
+        # --- scores --- #
+
+        if settings.SIGNAL_SCORE_NONPROFIT == 'fundraised_descending':
+            nonprofits = models.Nonprofit.objects.exclude(
+                username=settings.IBIS_USERNAME_ROOT).order_by(
+                    'score', 'id').values_list('id', 'score')
+
+            previous = None
+            for batch in _batches(nonprofits, chunk_size):
+                for nonprofit_id, score in batch:
+                    current = fundraised[nonprofit_id]
+                    if previous is not None and current > previous[1]:
+                        report(
+                            'Nonprofit {} (score {}) fundraised more than '
+                            'nonprofit {}'.format(nonprofit_id, score,
+                                                  previous[0]))
+                    previous = (nonprofit_id, current)
+
+        if violations:
+            raise CommandError('Found {} violation(s)'.format(violations))
+
+        self.stdout.write('No violations found')
@@ -0,0 +1,11 @@
+import ibis.models as models
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Fill in the search names of users stored without them'
+
+    def handle(self, *args, **options):
+        count = models.fill_search_names()
+        self.stdout.write('Updated {} user(s)'.format(count))
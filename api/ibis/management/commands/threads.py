@@ -0,0 +1,11 @@
+import ibis.models as models
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Fill in the thread columns of comments stored without them'
+
+    def handle(self, *args, **options):
+        count = models.fill_comment_threads()
+        self.stdout.write('Updated {} comment(s)'.format(count))
@@ -0,0 +1,14 @@
+import ibis.models as models
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Recompute trending scores of entries with new engagement'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk_size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        count = models.update_trending(chunk_size=options['chunk_size'])
+        self.stdout.write('Updated {} trending score(s)'.format(count))
@@ -18,8 +18,7 @@ def BotGasMiddleware(get_response):
             if bot.balance() >= bot.tank / settings.BOT_GAS_PRICE:
                 models.Donation.create(
                     user=bot,
-                    target=models.Nonprofit.objects.get(
-                        username=settings.ROOT_NONPROFIT_USERNAME),
+                    target=models.get_root_nonprofit(),
                     amount=bot.tank / settings.GAS_PRICE,
                 )
             else:
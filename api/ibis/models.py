@@ -1,9 +1,18 @@
 import re
-
-from django.db import models
+import math
+import time
+import random
+
+from functools import partial
+from django.db import models, transaction, connection
+from django.db import OperationalError, IntegrityError
+from django.dispatch import Signal
+from django.db.models import F, Sum, Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.core.exceptions import ValidationError
 from django.core.validators import MinLengthValidator
 from django.conf import settings
+from django.utils.timezone import now, timedelta
 from model_utils.models import TimeStampedModel
 from graphql_relay.node.node import to_global_id
 
@@ -12,6 +21,72 @@ from users.models import User
 MIN_USERNAME_LEN = 3
 MAX_USERNAME_LEN = 15
 
+# @username and @<global id> tokens in entry descriptions
+MENTION_RE = re.compile(r'(?<!\w)@(\w{{{},{}}})(?!\w)'.format(
+    MIN_USERNAME_LEN,
+    MAX_USERNAME_LEN,
+))
+MENTION_ID_RE = re.compile(r'(?<!\w)@([\w+/=]+)')
+
+# sent instead of post_save for donations and transactions created in bulk
+transfers_created = Signal(providing_args=['instances'])
+
+RANK_SQL = '''
+UPDATE {ibisuser} SET score = ranked.rank FROM (
+    SELECT n.ibisuser_ptr_id AS id, ROW_NUMBER() OVER (
+        ORDER BY COALESCE(a.fundraised, 0) DESC, n.ibisuser_ptr_id
+    ) AS rank
+    FROM {nonprofit} n
+    JOIN {user} u ON u.id = n.ibisuser_ptr_id
+    LEFT JOIN {account} a ON a.user_id = n.ibisuser_ptr_id
+    WHERE u.username <> %(root)s
+) ranked
+WHERE {ibisuser}.user_ptr_id = ranked.id AND {ibisuser}.score <> ranked.rank
+'''
+
+POST_SQL = '''
+UPDATE {account} SET balance = {account}.balance + v.balance,
+    fundraised = {account}.fundraised + v.fundraised
+FROM (VALUES {values}) AS v(user_id, balance, fundraised)
+WHERE {account}.user_id = v.user_id
+RETURNING {account}.user_id
+'''
+
+STATEMENT_SQL = '''
+SELECT kind, id, created, amount, inbound, counterparty_id, {start} - COALESCE(
+    SUM(amount) OVER (
+        ORDER BY created DESC, kind DESC, id DESC, inbound DESC
+        ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+    ), 0) AS balance
+FROM (
+    SELECT 'Deposit' AS kind, id, created, amount, TRUE AS inbound,
+        NULL::integer AS counterparty_id
+    FROM {deposit} WHERE user_id = %(user)s
+    UNION ALL
+    SELECT 'Withdrawal', id, created, -amount, FALSE, NULL
+    FROM {withdrawal} WHERE user_id = %(user)s
+    UNION ALL
+    SELECT 'Donation', e.id, e.created, -t.amount, FALSE, t.target_id
+    FROM {donation} t JOIN {entry} e ON e.id = t.entry_ptr_id
+    WHERE e.user_id = %(user)s
+    UNION ALL
+    SELECT 'Donation', e.id, e.created, t.amount, TRUE, e.user_id
+    FROM {donation} t JOIN {entry} e ON e.id = t.entry_ptr_id
+    WHERE t.target_id = %(user)s
+    UNION ALL
+    SELECT 'Transaction', e.id, e.created, -t.amount, FALSE, t.target_id
+    FROM {transaction} t JOIN {entry} e ON e.id = t.entry_ptr_id
+    WHERE e.user_id = %(user)s
+    UNION ALL
+    SELECT 'Transaction', e.id, e.created, t.amount, TRUE, e.user_id
+    FROM {transaction} t JOIN {entry} e ON e.id = t.entry_ptr_id
+    WHERE t.target_id = %(user)s
+) ledger
+{keyset}
+ORDER BY created DESC, kind DESC, id DESC, inbound DESC
+LIMIT %(limit)s
+'''
+
 
 def username_validator(value):
     if type(value) != str:
@@ -36,15 +111,26 @@ def generate_valid_username(first_name, last_name):
     if len(base) < MIN_USERNAME_LEN:
         base = '___'
 
-    name = base
-    index = 1
+    # candidates are base, base_2, base_3, ... with the base truncated to
+    # make room for the suffix, so one prefix query covers all candidates
+    # with suffixes of up to the given number of digits
+    digits = 3
+    while True:
+        taken = set(
+            IbisUser.objects.filter(
+                username__startswith=base[:MAX_USERNAME_LEN - digits - 1],
+            ).values_list('username', flat=True))
+
+        if base not in taken:
+            return base
 
-    while IbisUser.objects.filter(username=name).exists():
-        index += 1
-        suffix = '_{}'.format(index)
-        name = base[:MAX_USERNAME_LEN - len(suffix)] + suffix
+        for index in range(2, 10**digits):
+            suffix = '_{}'.format(index)
+            name = base[:MAX_USERNAME_LEN - len(suffix)] + suffix
+            if name not in taken:
+                return name
 
-    return name
+        digits += 1
 
 
 class Scoreable(models.Model):
@@ -79,6 +165,14 @@ class IbisUser(User, Scoreable):
     privacy_transaction = models.BooleanField(default=False)
     privacy_deposit = models.BooleanField(default=False)
 
+    # lowercase display name for prefix lookups by autocomplete_users
+    search_name = models.CharField(
+        max_length=255,
+        default='',
+        db_index=True,
+        editable=False,
+    )
+
     def __str__(self):
         return '{}{}{}'.format(
             self.first_name,
@@ -87,19 +181,60 @@ class IbisUser(User, Scoreable):
         )
 
     def balance(self):
-        return sum([
-            +sum([x.amount for x in Deposit.objects.filter(user=self.id)]),
-            +sum([x.amount for x in Donation.objects.filter(target=self.id)]),
-            +sum(
-                [x.amount
-                 for x in Transaction.objects.filter(target=self.id)]),
-            -sum([x.amount for x in Donation.objects.filter(user=self.id)]),
-            -sum([x.amount for x in Transaction.objects.filter(user=self.id)]),
-            -sum([x.amount for x in Withdrawal.objects.filter(user=self.id)]),
-        ])
+        balance = Account.objects.filter(user_id=self.id).values_list(
+            'balance', flat=True).first()
+        if balance is None:
+            balance = Account.objects.get_or_create(
+                user_id=self.id,
+                defaults={
+                    'balance': calculate_balances([self.id])[self.id],
+                    'fundraised': calculate_fundraised([self.id])[self.id],
+                },
+            )[0].balance
+        return balance
 
     def donated(self):
-        return sum([x.amount for x in Donation.objects.filter(user=self)])
+        return calculate_donated([self.id])[self.id]
+
+    def statement(self, limit, after=None):
+        """Return up to limit rows of the merged transfer ledger, newest
+        first, with the running balance after each row. Pagination is by
+        keyset: after is the (created, kind, id, inbound, balance) key of
+        the last row of the previous page, where balance is the balance
+        before that row, so deeper pages never rescan newer rows. The key
+        is trusted as is, so it must come from a previous call.
+        """
+
+        self.balance()  # make sure that the account exists
+
+        params = {'user': self.id, 'limit': limit}
+
+        if after:
+            (params['created'], params['kind'], params['id'],
+             params['inbound'], params['start']) = after
+            start = '%(start)s'
+            keyset = ('WHERE (created, kind, id, inbound) < '
+                      '(%(created)s, %(kind)s, %(id)s, %(inbound)s)')
+        else:
+            start = '(SELECT balance FROM {} WHERE user_id = %(user)s)'.format(
+                Account._meta.db_table)
+            keyset = ''
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                STATEMENT_SQL.format(
+                    start=start,
+                    keyset=keyset,
+                    deposit=Deposit._meta.db_table,
+                    withdrawal=Withdrawal._meta.db_table,
+                    entry=Entry._meta.db_table,
+                    donation=Donation._meta.db_table,
+                    transaction=Transaction._meta.db_table,
+                ),
+                params,
+            )
+            columns = [x[0] for x in cursor.description]
+            return [dict(zip(columns, x)) for x in cursor.fetchall()]
 
     def can_see(self, entry):
         if hasattr(entry, 'comment'):
@@ -116,6 +251,204 @@ class IbisUser(User, Scoreable):
     def clean(self):
         username_validator(self.username)
 
+    def save(self, *args, **kwargs):
+        self.search_name = str(self).lower()[:255]
+        super().save(*args, **kwargs)
+
+
+def autocomplete_users(user, value, limit):
+    """Return up to limit users whose username or display name starts
+    with the given value, users followed by the given user first. Each
+    lookup is a range scan over a prefix index, never a full table scan.
+    """
+
+    value = value.lstrip('@').lower()
+    if not value:
+        return []
+
+    match = models.Q(username__startswith=value) | models.Q(
+        search_name__startswith=value)
+
+    # the followed users are few, so they are filtered directly
+    followed = list(
+        IbisUser.objects.filter(follower=user.id).filter(match).order_by(
+            'username').values_list('id', flat=True)[:limit])
+
+    # unordered so that the lookups stop after the first matches
+    ids = list(followed)
+    for field in ['username', 'search_name']:
+        if len(ids) < limit:
+            ids += [
+                x for x in IbisUser.objects.filter(**{
+                    '{}__startswith'.format(field): value
+                }).order_by().values_list('id', flat=True)[:limit]
+                if x not in ids
+            ]
+
+    users = IbisUser.objects.in_bulk(ids[:limit])
+    return sorted(
+        users.values(),
+        key=lambda x: (x.id not in followed, x.username),
+    )
+
+
+def fill_search_names():
+    """Fill in the search names of users stored without them. Return the
+    number of users."""
+
+    users = list(
+        IbisUser.objects.filter(search_name='').only('first_name',
+                                                     'last_name'))
+    for user in users:
+        user.search_name = str(user).lower()[:255]
+    users = [x for x in users if x.search_name]
+
+    IbisUser.objects.bulk_update(users, ['search_name'], batch_size=1000)
+    return len(users)
+
+
+class Account(models.Model):
+    user = models.OneToOneField(
+        IbisUser,
+        on_delete=models.CASCADE,
+        primary_key=True,
+    )
+
+    balance = models.IntegerField(default=0)
+    fundraised = models.IntegerField(default=0, db_index=True)
+
+    def __str__(self):
+        return '{}:{:.2f}'.format(self.user, self.balance / 100)
+
+    @classmethod
+    def create_missing(cls, user_ids):
+        """Create the accounts of the given users that do not exist yet"""
+        missing = set(user_ids) - set(
+            cls.objects.filter(user_id__in=user_ids).values_list(
+                'user_id', flat=True))
+        if missing:
+            balances = calculate_balances(list(missing))
+            fundraised = calculate_fundraised(list(missing))
+            cls.objects.bulk_create(
+                [
+                    cls(
+                        user_id=x,
+                        balance=balances[x],
+                        fundraised=fundraised[x],
+                    ) for x in missing
+                ],
+                ignore_conflicts=True,
+            )
+
+    @classmethod
+    def lock(cls, user_ids):
+        """Lock the accounts of the given users (in a fixed order to avoid
+        deadlocks) and return a {user id: balance} dictionary"""
+        return dict(
+            cls.objects.select_for_update().filter(
+                user_id__in=user_ids).order_by('user_id').values_list(
+                    'user_id', 'balance'))
+
+    @classmethod
+    def post(cls, postings, fundraising=[], create=True):
+        """Apply lists of (user id, amount) balance postings and fundraising
+        postings to the materialized totals. Missing accounts are created
+        from the transfer tables, which already include the postings being
+        applied, unless create is False (e.g. while the user is deleted).
+        """
+
+        totals = {}
+        for i, changes in enumerate([postings, fundraising]):
+            for user_id, amount in changes:
+                totals.setdefault(user_id, [0, 0])[i] += amount
+
+        if not totals:
+            return
+
+        # one statement regardless of how many accounts are touched
+        with connection.cursor() as cursor:
+            cursor.execute(
+                POST_SQL.format(
+                    account=cls._meta.db_table,
+                    values=', '.join(['(%s, %s, %s)'] * len(totals)),
+                ),
+                [x for user_id in sorted(totals)
+                 for x in [user_id] + totals[user_id]],
+            )
+            updated = set(x[0] for x in cursor.fetchall())
+
+        if not create:
+            return
+
+        for user_id in sorted(set(totals) - updated):
+            cls.objects.create(
+                user_id=user_id,
+                balance=calculate_balances([user_id])[user_id],
+                fundraised=calculate_fundraised([user_id])[user_id],
+            )
+
+
+class IdempotencyKey(models.Model):
+    class Meta:
+        unique_together = [['user', 'operation', 'key']]
+
+    user = models.ForeignKey(
+        IbisUser,
+        on_delete=models.CASCADE,
+    )
+    operation = models.CharField(max_length=63)
+    key = models.CharField(max_length=255)
+    reference = models.IntegerField(null=True, blank=True)
+    created = models.DateTimeField(default=now, db_index=True)
+
+    def __str__(self):
+        return '{}:{}:{}'.format(self.user, self.operation, self.key)
+
+    @staticmethod
+    def expiration():
+        return now() - timedelta(hours=settings.IDEMPOTENCY_KEY_TTL)
+
+    @classmethod
+    def lookup(cls, user, operation, key):
+        """Return the object id stored for an unexpired key or None"""
+        return cls.objects.filter(
+            user=user,
+            operation=operation,
+            key=key,
+            created__gte=cls.expiration(),
+        ).values_list('reference', flat=True).first()
+
+    @classmethod
+    def claim(cls, user, operation, key):
+        """Create the key within the caller's transaction. A concurrent
+        request with the same key blocks until this transaction finishes.
+        Return None if the key was already claimed by another request
+        """
+        cls.objects.filter(
+            user=user,
+            operation=operation,
+            key=key,
+            created__lt=cls.expiration(),
+        ).delete()
+
+        try:
+            with transaction.atomic():
+                return cls.objects.create(
+                    user=user,
+                    operation=operation,
+                    key=key,
+                )
+        except IntegrityError:
+            return None
+
+
+class InsufficientBalance(Exception):
+    pass
+
+
+class IdempotencyKeyInUse(Exception):
+    pass
+
 
 class Valuable(models.Model):
     amount = models.PositiveIntegerField()
@@ -123,6 +456,34 @@ class Valuable(models.Model):
     class Meta:
         abstract = True
 
+    def postings(self):
+        """Return the (user id, amount) balance changes caused by the
+        transfer"""
+        raise NotImplementedError
+
+    def fundraising(self):
+        """Return the (user id, amount) fundraised changes caused by the
+        transfer"""
+        return []
+
+    def apply_to_accounts(self, sign=1, create=True):
+        """Apply (or reverse, with sign=-1) the transfer to the accounts"""
+        Account.post(
+            [(x, sign * y) for x, y in self.postings()],
+            [(x, sign * y) for x, y in self.fundraising()],
+            create=create,
+        )
+
+    def save(self, *args, **kwargs):
+        # keep the materialized balances in the same transaction as the row
+        with transaction.atomic():
+            if not self._state.adding:
+                previous = type(self).objects.filter(pk=self.pk).first()
+                if previous:
+                    previous.apply_to_accounts(sign=-1, create=False)
+            super().save(*args, **kwargs)
+            self.apply_to_accounts()
+
 
 class Rsvpable(models.Model):
     rsvp = models.ManyToManyField(
@@ -166,7 +527,12 @@ class Nonprofit(IbisUser):
     )
 
     def fundraised(self):
-        return sum([x.amount for x in Donation.objects.filter(target=self)])
+        fundraised = Account.objects.filter(user_id=self.id).values_list(
+            'fundraised', flat=True).first()
+        if fundraised is None:
+            self.balance()  # creates the account from the transfer tables
+            fundraised = Account.objects.get(user_id=self.id).fundraised
+        return fundraised
 
 
 class Person(IbisUser):
@@ -191,6 +557,7 @@ class Entry(TimeStampedModel, Scoreable):
     class Meta:
         verbose_name = "Entry"
         verbose_name_plural = "Entries"
+        indexes = [models.Index(fields=['user', 'created'])]
 
     user = models.ForeignKey(
         IbisUser,
@@ -217,60 +584,174 @@ class Entry(TimeStampedModel, Scoreable):
         blank=True,
     )
 
+    trending = models.FloatField(default=0, db_index=True)
+    trending_stale = models.BooleanField(default=True, db_index=True)
+
+    # description with mentions resolved to usernames; null when stale
+    rendered_description = models.TextField(
+        null=True,
+        blank=True,
+        editable=False,
+    )
+
     def save(self, *args, **kwargs):
+        adding = self._state.adding
+        if adding:
+            self.trending = trending_score(0, self.created)
+
         if (hasattr(self, 'donation')
                 and self.donation.private) or (hasattr(self, 'transaction')
                                                and self.transaction.private):
+            self.rendered_description = self.description
             return super().save(*args, **kwargs)
 
-        mention = set(
-            IbisUser.objects.get(username=x[2:-1]) for x in re.findall(
-                r'\W@\w{{{},{}}}\W'.format(
-                    MIN_USERNAME_LEN,
-                    MAX_USERNAME_LEN,
-                ),
-                ' ' + self.description + ' ',
-            ) if IbisUser.objects.filter(username=x[2:-1]).exists())
-
-        for x in mention:
-            self.description = re.sub(
-                r'(\W)@{}(\W)'.format(x.username),
-                r'\1@{}\2'.format(to_global_id('IbisUserNode', str(x.id))),
-                ' ' + self.description + ' ',
-            )[1:-1]
+        self.description, mention = Entry.parse_mentions(self.description)
+
+        # mentions are kept as long as the global id is still referenced
+        referenced = set(MENTION_ID_RE.findall(self.description))
+        mentioned = set(x.id for x in mention)
+        current = set() if adding else set(
+            self.mention.values_list('id', flat=True))
+
+        kept = [
+            x for x in current - mentioned
+            if to_global_id('IbisUserNode', str(x)) in referenced
+        ]
+        self.rendered_description = Entry.render_description(
+            self.description,
+            mention.union(IbisUser.objects.filter(id__in=kept))
+            if kept else mention,
+        )
 
         super().save(*args, **kwargs)
 
-        for x in self.mention.all():
-            if x not in mention and not re.findall(
-                    r'\W@{}\W'.format(
-                        re.escape(to_global_id(
-                            'IbisUserNode',
-                            str(x.id),
-                        ))),
-                    ' ' + self.description + ' ',
-            ):
-                self.mention.remove(x)
+        stale = current - mentioned - set(kept)
+        if stale:
+            self.mention.remove(*stale)
+        if mentioned - current:
+            self.mention.add(*(mentioned - current))
+
+    @staticmethod
+    def parse_mentions(description):
+        """Return the description with @username mentions replaced by the
+        global ids of the users along with the set of mentioned users"""
+
+        names = set(MENTION_RE.findall(description))
+        users = {
+            x.username: x
+            for x in IbisUser.objects.filter(username__in=names)
+        } if names else {}
+
+        description = MENTION_RE.sub(
+            lambda x: '@{}'.format(
+                to_global_id('IbisUserNode', str(users[x.group(1)].id)))
+            if x.group(1) in users else x.group(0),
+            description,
+        )
+
+        return description, set(users.values())
+
+    @staticmethod
+    def render_description(description, users):
+        """Return the description with the global ids of the given users
+        replaced by their usernames"""
 
-        for user in [
-                x for x in mention
-                if not self.mention.filter(id=x.id).exists()
-        ]:
-            self.mention.add(user)
+        usernames = {
+            to_global_id('IbisUserNode', str(x.id)): x.username
+            for x in users
+        }
+
+        return MENTION_ID_RE.sub(
+            lambda x: '@{}'.format(usernames[x.group(1)])
+            if x.group(1) in usernames else x.group(0),
+            description,
+        )
 
     def resolve_description(self):
-        description = self.description
-        for x in self.mention.all():
-            description = re.sub(
-                r'(\W)@{}(\W)'.format(
-                    re.escape(to_global_id(
-                        'IbisUserNode',
-                        str(x.id),
-                    ))),
-                r'\1@{}\2'.format(x.username),
-                ' ' + description + ' ',
-            )[1:-1]
-        return description
+        if self.rendered_description is None:
+            render_descriptions([self])
+        return self.rendered_description
+
+
+def render_descriptions(entries):
+    """Fill in the rendered descriptions of the given entries that are
+    stale, looking up the mentioned usernames of all of them at once"""
+
+    stale = [x for x in entries if x.rendered_description is None]
+    if not stale:
+        return
+
+    users = {x.id: [] for x in stale}
+    for entry_id, user_id, username in Entry.mention.through.objects.filter(
+            entry_id__in=users).values_list(
+                'entry_id',
+                'ibisuser_id',
+                'ibisuser__username',
+            ):
+        users[entry_id].append(IbisUser(id=user_id, username=username))
+
+    for entry in stale:
+        entry.rendered_description = Entry.render_description(
+            entry.description,
+            users[entry.id],
+        )
+
+    Entry.objects.bulk_update(stale, ['rendered_description'])
+
+
+class ReferenceVersion(models.Model):
+    """Single row version stamp of the reference data cached in each
+    process. Bumped whenever cached reference data changes."""
+
+    version = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return str(self.version)
+
+
+_reference = {'version': None, 'checked': 0, 'values': {}}
+
+
+def get_reference(key, loader):
+    """Return rarely changing reference data (categories, templates, etc.)
+    from the process-wide cache, calling loader on a miss. Every process
+    compares its cache to the version stamp at most once per
+    REFERENCE_CACHE_TTL seconds and drops it if the stamp moved.
+    """
+
+    ttl = settings.REFERENCE_CACHE_TTL
+    if time.monotonic() - _reference['checked'] > ttl:
+        version = ReferenceVersion.objects.get_or_create(pk=1)[0].version
+        if version != _reference['version']:
+            _reference['version'] = version
+            _reference['values'] = {}
+        _reference['checked'] = time.monotonic()
+
+    if key not in _reference['values']:
+        _reference['values'][key] = loader()
+
+    return _reference['values'][key]
+
+
+def bump_reference_version():
+    if not ReferenceVersion.objects.filter(pk=1).update(
+            version=F('version') + 1):
+        ReferenceVersion.objects.get_or_create(pk=1)
+    _reference['values'] = {}
+
+
+def get_deposit_category(title):
+    return get_reference(
+        'deposit_category:{}'.format(title),
+        lambda: DepositCategory.objects.get(title=title),
+    )
+
+
+def get_root_nonprofit():
+    return get_reference(
+        'root_nonprofit',
+        lambda: Nonprofit.objects.get(username=settings.IBIS_USERNAME_ROOT),
+    )
 
 
 class DepositCategory(models.Model):
@@ -284,6 +765,9 @@ class DepositCategory(models.Model):
 
 
 class Deposit(TimeStampedModel, Valuable, Hideable):
+    class Meta:
+        indexes = [models.Index(fields=['user', 'created'])]
+
     user = models.ForeignKey(
         IbisUser,
         on_delete=models.CASCADE,
@@ -295,6 +779,9 @@ class Deposit(TimeStampedModel, Valuable, Hideable):
     payment_id = models.TextField(
         unique=True, validators=[MinLengthValidator(1)])
 
+    def postings(self):
+        return [(self.user_id, self.amount)]
+
     def __str__(self):
         return '{}:{}:{:.2f}'.format(
             self.pk,
@@ -304,12 +791,18 @@ class Deposit(TimeStampedModel, Valuable, Hideable):
 
 
 class Withdrawal(TimeStampedModel, Valuable):
+    class Meta:
+        indexes = [models.Index(fields=['user', 'created'])]
+
     user = models.ForeignKey(
         Nonprofit,
         on_delete=models.CASCADE,
     )
     description = models.TextField(blank=True)
 
+    def postings(self):
+        return [(self.user_id, -self.amount)]
+
     def __str__(self):
         return '{}:{}:{:.2f}'.format(
             self.pk,
@@ -324,6 +817,12 @@ class Donation(Entry, Valuable, Hideable):
         on_delete=models.CASCADE,
     )
 
+    def postings(self):
+        return [(self.user_id, -self.amount), (self.target_id, self.amount)]
+
+    def fundraising(self):
+        return [(self.target_id, self.amount)]
+
     def __str__(self):
         return '{}:{}->{}:{:.2f}'.format(
             self.pk,
@@ -339,6 +838,33 @@ class Transaction(Entry, Valuable, Hideable):
         on_delete=models.CASCADE,
     )
 
+    def postings(self):
+        return [(self.user_id, -self.amount), (self.target_id, self.amount)]
+
+    def __str__(self):
+        return '{}:{}->{}:{:.2f}'.format(
+            self.pk,
+            self.user,
+            self.target,
+            self.amount / 100,
+        )
+
+
+class RecurringDonation(TimeStampedModel, Hideable):
+    user = models.ForeignKey(
+        IbisUser,
+        on_delete=models.CASCADE,
+    )
+    target = models.ForeignKey(
+        Nonprofit,
+        related_name='recurring_donation_for',
+        on_delete=models.CASCADE,
+    )
+    amount = models.PositiveIntegerField()
+    description = models.TextField(validators=[MinLengthValidator(1)])
+    active = models.BooleanField(default=True, db_index=True)
+    last_settled = models.DateTimeField(null=True, blank=True)
+
     def __str__(self):
         return '{}:{}->{}:{:.2f}'.format(
             self.pk,
@@ -377,12 +903,33 @@ class Post(Entry):
 
 
 class Comment(Entry):
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['path'],
+                name='ibis_comment_path_idx',
+                opclasses=['text_pattern_ops'],
+            )
+        ]
+
     parent = models.ForeignKey(
         Entry,
         related_name='parent_of',
         on_delete=models.CASCADE,
     )
 
+    # the thread of a comment, filled in on insert: the entry at the top
+    # of the thread, the number of parents and the ids of all parents
+    root = models.ForeignKey(
+        Entry,
+        related_name='thread_of',
+        on_delete=models.CASCADE,
+        null=True,
+        editable=False,
+    )
+    depth = models.PositiveIntegerField(default=0, editable=False)
+    path = models.TextField(default='', editable=False)
+
     def __str__(self):
         return '{}:{}->{}'.format(
             self.pk,
@@ -390,8 +937,484 @@ class Comment(Entry):
             self.parent.user,
         )
 
+    def save(self, *args, **kwargs):
+        if self._state.adding and self.root_id is None:
+            parent = Comment.objects.filter(pk=self.parent_id).values(
+                'root_id', 'depth', 'path').first()
+            if parent is None:
+                self.root_id = self.parent_id
+                self.depth = 1
+                self.path = thread_path(self.parent_id)
+            elif parent['root_id'] is not None:
+                self.root_id = parent['root_id']
+                self.depth = parent['depth'] + 1
+                self.path = parent['path'] + thread_path(self.parent_id)
+
+        super().save(*args, **kwargs)
+
     def get_root(self):
-        current = Entry.objects.get(pk=self.pk)
-        while hasattr(current, 'comment'):
-            current = current.comment.parent
-        return current
+        if self.root_id is None:
+            current = Entry.objects.get(pk=self.pk)
+            while hasattr(current, 'comment'):
+                current = current.comment.parent
+            return current
+
+        return Entry.objects.get(pk=self.root_id)
+
+    def get_ancestor_ids(self):
+        """Return the ids of the parents of the comment from the root down"""
+        if self.root_id is None:
+            ids = [self.parent_id]
+            current = self.parent
+            while hasattr(current, 'comment'):
+                current = current.comment.parent
+                ids.insert(0, current.pk)
+            return ids
+
+        return [int(x) for x in self.path.split('/') if x]
+
+    def get_descendants(self):
+        """Return all replies below the comment with one range query"""
+        return Comment.objects.filter(
+            path__startswith=self.path + thread_path(self.pk))
+
+
+def thread_path(entry_id):
+    # fixed width so that paths sort and prefix match by ancestry
+    return '{:010d}/'.format(entry_id)
+
+
+def fill_comment_threads():
+    """Fill in the thread columns of comments stored without them, one
+    level of the threads at a time. Return the number of comments."""
+
+    count = 0
+    while True:
+        comments = list(
+            Comment.objects.filter(root__isnull=True).filter(
+                models.Q(parent__comment__isnull=True)
+                | models.Q(parent__comment__root__isnull=False)
+            ).select_related('parent__comment'))
+        if not comments:
+            return count
+
+        for comment in comments:
+            parent = getattr(comment.parent, 'comment', None)
+            if parent:
+                comment.root_id = parent.root_id
+                comment.depth = parent.depth + 1
+                comment.path = parent.path + thread_path(parent.pk)
+            else:
+                comment.root_id = comment.parent_id
+                comment.depth = 1
+                comment.path = thread_path(comment.parent_id)
+
+        Comment.objects.bulk_update(comments, ['root', 'depth', 'path'])
+        count += len(comments)
+
+
+def trending_score(engagement, created):
+    """Return the hot score of an entry
+
+    Engagement is weighted on a log scale and the creation time adds a
+    linear bonus, so an entry must gain 10x the engagement every
+    TRENDING_DECAY hours to keep its place. Since every entry ages at the
+    same rate, the ordering is the same as decaying engagement over time
+    and scores only need to be recomputed when engagement changes.
+    """
+    return math.log10(1 + engagement) + created.timestamp() / (
+        settings.TRENDING_DECAY * 3600)
+
+
+def calculate_trending(entry_ids):
+    weights = settings.TRENDING_WEIGHTS
+    engagement = {x: 0 for x in entry_ids}
+
+    for through, field, weight in [
+        (Entry.like.through, 'entry_id', weights['like']),
+        (Entry.mention.through, 'entry_id', weights['mention']),
+        (Event.rsvp.through, 'event_id', weights['rsvp']),
+        (Comment, 'parent_id', weights['comment']),
+    ]:
+        for entry_id, count in through.objects.filter(**{
+                '{}__in'.format(field): entry_ids
+        }).order_by().values_list(field).annotate(count=Count('pk')):
+            engagement[entry_id] += weight * count
+
+    return {
+        x: trending_score(engagement[x], created)
+        for x, created in Entry.objects.filter(
+            id__in=entry_ids).values_list('id', 'created')
+    }
+
+
+def mark_trending_stale(entry_ids):
+    return Entry.objects.filter(
+        id__in=entry_ids,
+        trending_stale=False,
+    ).update(trending_stale=True)
+
+
+def update_trending(chunk_size=1000):
+    """Recompute the trending score of every entry touched since the last
+    run and return the number of entries updated"""
+    count = 0
+
+    while True:
+        entry_ids = list(
+            Entry.objects.filter(trending_stale=True).order_by(
+                'id').values_list('id', flat=True)[:chunk_size])
+        if not entry_ids:
+            return count
+
+        # clear the flag first so that engagement arriving while scoring
+        # marks the entry stale again for the next run
+        Entry.objects.filter(id__in=entry_ids).update(trending_stale=False)
+
+        scores = calculate_trending(entry_ids)
+        entries = [Entry(id=x, trending=scores[x]) for x in scores]
+        Entry.objects.bulk_update(entries, ['trending'])
+        count += len(entries)
+
+
+def _transfer_total(model, field, start=None, end=None):
+    queryset = model.objects.filter(**{field: OuterRef('pk')})
+    if start:
+        queryset = queryset.filter(created__gte=start)
+    if end:
+        queryset = queryset.filter(created__lt=end)
+
+    return Coalesce(
+        Subquery(
+            queryset.order_by().values(field).annotate(
+                total=Sum('amount')).values('total'),
+            output_field=models.IntegerField(),
+        ),
+        0,
+    )
+
+
+def _transfer_totals(model, field, user_ids):
+    totals = {x: 0 for x in user_ids}
+    totals.update(
+        model.objects.filter(**{
+            '{}__in'.format(field): user_ids
+        }).order_by().values(field).annotate(
+            total=Sum('amount')).values_list(field, 'total'))
+    return totals
+
+
+def calculate_balances(user_ids=None, start=None, end=None):
+    """Calculate a {user id: balance} dictionary for the given users (or all
+    users if no ids are specified) from the transfer tables in a single
+    query with one aggregate subquery per transfer type. The optional
+    start and end times restrict the sum to transfers within [start, end)
+    """
+
+    queryset = IbisUser.objects.order_by()
+    if user_ids is not None:
+        queryset = queryset.filter(id__in=user_ids)
+
+    balances = {x: 0 for x in user_ids} if user_ids is not None else {}
+    balances.update(
+        queryset.annotate(
+            balance_total=_transfer_total(Deposit, 'user', start, end) +
+            _transfer_total(Donation, 'target', start, end) +
+            _transfer_total(Transaction, 'target', start, end) -
+            _transfer_total(Donation, 'user', start, end) -
+            _transfer_total(Transaction, 'user', start, end) -
+            _transfer_total(Withdrawal, 'user', start, end),
+        ).values_list('id', 'balance_total'))
+    return balances
+
+
+def calculate_balance_changes(start=None, end=None):
+    """Calculate a {user id: net change} dictionary of all transfers created
+    within [start, end) with one grouped query per transfer type. Users
+    without any transfers in the window are omitted.
+    """
+
+    changes = {}
+
+    for model, field, sign in [
+        (Deposit, 'user', +1),
+        (Donation, 'target', +1),
+        (Transaction, 'target', +1),
+        (Donation, 'user', -1),
+        (Transaction, 'user', -1),
+        (Withdrawal, 'user', -1),
+    ]:
+        queryset = model.objects.order_by()
+        if start:
+            queryset = queryset.filter(created__gte=start)
+        if end:
+            queryset = queryset.filter(created__lt=end)
+        for user_id, total in queryset.values(field).annotate(
+                total=Sum('amount')).values_list(field, 'total'):
+            changes[user_id] = changes.get(user_id, 0) + sign * total
+
+    return changes
+
+
+def rank_nonprofits():
+    """Set the score of every nonprofit (except the root) to its rank by
+    materialized fundraised total in a single set-based update that only
+    touches nonprofits whose rank changed. Return the number of updates.
+    """
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            RANK_SQL.format(
+                ibisuser=IbisUser._meta.db_table,
+                nonprofit=Nonprofit._meta.db_table,
+                user=User._meta.db_table,
+                account=Account._meta.db_table,
+            ),
+            {'root': settings.IBIS_USERNAME_ROOT},
+        )
+        return cursor.rowcount
+
+
+def calculate_donated(user_ids):
+    """Calculate a {user id: donated amount} dictionary in a single query"""
+    return _transfer_totals(Donation, 'user', user_ids)
+
+
+def calculate_fundraised(user_ids):
+    """Calculate a {nonprofit id: fundraised amount} dictionary in a single
+    query"""
+    return _transfer_totals(Donation, 'target', user_ids)
+
+
+def rebuild_accounts():
+    """Recalculate all materialized balances from the transfer tables and
+    return the number of accounts that had to be created or corrected.
+    Transfers are blocked on the account locks while this runs.
+    """
+
+    with transaction.atomic():
+        accounts = {
+            x.user_id: x
+            for x in Account.objects.select_for_update()
+        }
+        balances = calculate_balances()
+        fundraised = dict(
+            Donation.objects.order_by().values('target').annotate(
+                total=Sum('amount')).values_list('target', 'total'))
+
+        created = [
+            Account(
+                user_id=x,
+                balance=balances.get(x, 0),
+                fundraised=fundraised.get(x, 0),
+            ) for x in IbisUser.objects.values_list('id', flat=True)
+            if x not in accounts
+        ]
+        Account.objects.bulk_create(created)
+
+        updated = []
+        for user_id, account in accounts.items():
+            if (account.balance, account.fundraised) != (
+                    balances.get(user_id, 0),
+                    fundraised.get(user_id, 0),
+            ):
+                account.balance = balances.get(user_id, 0)
+                account.fundraised = fundraised.get(user_id, 0)
+                updated.append(account)
+        Account.objects.bulk_update(updated, ['balance', 'fundraised'])
+
+    return len(created) + len(updated)
+
+
+def prepare_transfer(kwargs):
+    """Return the model arguments of a new donation or transaction with its
+    mentions parsed and its description rendered, along with the set of
+    mentioned users. Private transfers keep their description as is."""
+
+    description, mention = kwargs['description'], set()
+    if not kwargs.get('private'):
+        description, mention = Entry.parse_mentions(description)
+
+    return dict(
+        kwargs,
+        description=description,
+        rendered_description=Entry.render_description(description, mention),
+    ), mention
+
+
+def add_transfer_mentions(instances, mentions):
+    """Add the mentions of new transfers once their transaction commits, so
+    that mention notifications are not created under the account locks"""
+
+    def add():
+        for instance, mention in zip(instances, mentions):
+            if mention:
+                instance.mention.add(*mention)
+
+    if any(mentions):
+        transaction.on_commit(add)
+
+
+def create_transfer(model, idempotency_key=None, **kwargs):
+    """Create a donation or transaction only if the sender can afford it.
+    Both accounts are locked in a fixed order so that the balance check,
+    the insert and the balance update are one short atomic step that
+    concurrent transfers cannot interleave with. Notifications and other
+    side effects follow once the transaction commits. Deadlocks and lock
+    timeouts are retried a bounded number of times before the error is
+    re-raised. If an idempotency key is given, repeated calls return the
+    original object.
+    """
+
+    user, target = kwargs['user'], kwargs['target']
+
+    if idempotency_key:
+        reference = IdempotencyKey.lookup(user, model.__name__,
+                                          idempotency_key)
+        if reference:
+            return model.objects.get(pk=reference)
+
+    # make sure that both accounts exist before taking the locks
+    user.balance()
+    target.balance()
+
+    kwargs, mention = prepare_transfer(kwargs)
+
+    for attempt in range(settings.TRANSFER_RETRIES):
+        try:
+            with transaction.atomic():
+                if idempotency_key:
+                    claim = IdempotencyKey.claim(user, model.__name__,
+                                                 idempotency_key)
+                    if not claim:
+                        reference = IdempotencyKey.lookup(
+                            user, model.__name__, idempotency_key)
+                        # claimed, but its transfer is not linked yet
+                        if not reference:
+                            raise IdempotencyKeyInUse
+                        return model.objects.get(pk=reference)
+
+                balances = Account.lock([user.id, target.id])
+
+                if balances[user.id] < kwargs['amount']:
+                    raise InsufficientBalance
+
+                instance = insert_transfers([model(**kwargs)])[0]
+
+                if idempotency_key:
+                    claim.reference = instance.pk
+                    claim.save()
+
+            add_transfer_mentions([instance], [mention])
+            return instance
+        except OperationalError:
+            if attempt + 1 == settings.TRANSFER_RETRIES:
+                raise
+            time.sleep(random.random() * 0.05 * 2**attempt)
+
+
+def bulk_create_inherited(objs):
+    """Insert a list of unsaved instances of a multi-table inherited model
+    (one level deep, e.g. Donation or DonationNotification) with one
+    insert for the parent table and one for the child table. Django's
+    bulk_create does not support these models. No signals are sent.
+    """
+
+    if not objs:
+        return objs
+
+    model = type(objs[0])
+    parent_link = model._meta.pk
+    parent = parent_link.remote_field.model
+
+    parents = [
+        parent(
+            **{
+                x.attname: getattr(obj, x.attname)
+                for x in parent._meta.concrete_fields
+            }) for obj in objs
+    ]
+    parent.objects.bulk_create(parents)
+
+    for obj, parent_obj in zip(objs, parents):
+        for x in parent._meta.concrete_fields:
+            setattr(obj, x.attname, getattr(parent_obj, x.attname))
+        setattr(obj, parent_link.attname, parent_obj.pk)
+
+    model._base_manager._insert(
+        objs,
+        fields=model._meta.local_concrete_fields,
+        using=model.objects.db,
+    )
+
+    for obj in objs:
+        obj._state.adding = False
+        obj._state.db = model.objects.db
+
+    return objs
+
+
+def insert_transfers(instances):
+    """Bulk insert unsaved deposits, donations and transactions and post
+    them to the account balances. The caller is responsible for validating
+    balances within the current transaction. Instead of per-row post_save
+    signals, transfers_created is sent once per model with all new
+    instances after the transaction commits, outside of any locks.
+    """
+
+    for model in [Deposit, Donation, Transaction]:
+        created = [x for x in instances if type(x) == model]
+        if not created:
+            continue
+        if model == Deposit:
+            model.objects.bulk_create(created)
+        else:
+            bulk_create_inherited(created)
+        transaction.on_commit(
+            partial(transfers_created.send, sender=model, instances=created))
+
+    Account.post(
+        sum([x.postings() for x in instances], []),
+        sum([x.fundraising() for x in instances], []),
+    )
+
+    return instances
+
+
+def create_transfers(user, transfers):
+    """Create a batch of donations and transactions sent by the user. Each
+    transfer is a dictionary of model arguments and its type follows from
+    the target (nonprofit or person). The total is validated against a
+    single locked read of the sender's balance and the rows are inserted
+    in bulk within the same atomic step.
+    """
+
+    transfers = list(transfers)
+    user_ids = set([user.id] + [x['target'].id for x in transfers])
+
+    # make sure that all accounts exist before taking the locks
+    Account.create_missing(user_ids)
+
+    transfers, mentions = zip(*[prepare_transfer(x) for x in transfers])
+
+    for attempt in range(settings.TRANSFER_RETRIES):
+        try:
+            with transaction.atomic():
+                balances = Account.lock(user_ids)
+
+                if balances[user.id] < sum(x['amount'] for x in transfers):
+                    raise InsufficientBalance
+
+                instances = [
+                    (Donation if isinstance(x['target'], Nonprofit) else
+                     Transaction)(user=user, **x) for x in transfers
+                ]
+
+                insert_transfers(instances)
+
+            add_transfer_mentions(instances, mentions)
+            return instances
+        except OperationalError:
+            if attempt + 1 == settings.TRANSFER_RETRIES:
+                raise
+            time.sleep(random.random() * 0.05 * 2**attempt)
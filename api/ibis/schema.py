@@ -4,10 +4,12 @@ import django_filters
 import graphene
 import dateutil.parser
 import ibis.models as models
+import distribution.models
 
 from PIL import Image
 from django.db.models import Q, Count, Value
 from django.db.models.functions import Concat
+from django.core import signing
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.files.storage import default_storage
 from django.core.files.base import ContentFile
@@ -23,6 +25,29 @@ from users.schema import UserNode
 
 AVATAR_SIZE = (528, 528)
 
+STATEMENT_PAGE_SIZE = 25
+STATEMENT_PAGE_MAX = 100
+STATEMENT_CURSOR_SALT = 'ibis.statement'
+
+# --- Fields ---------------------------------------------------------------- #
+
+
+class EntryConnectionField(DjangoFilterConnectionField):
+    """Connection of entries that renders the stale descriptions of a
+    whole page at once instead of entry by entry"""
+
+    @classmethod
+    def resolve_connection(cls, connection, default_manager, args, iterable):
+        connection = super().resolve_connection(
+            connection,
+            default_manager,
+            args,
+            iterable,
+        )
+        models.render_descriptions([x.node for x in connection.edges])
+        return connection
+
+
 # --- Filters --------------------------------------------------------------- #
 
 
@@ -124,6 +149,15 @@ class WithdrawalFilter(django_filters.FilterSet):
         return qs.filter(Q(user_id=from_global_id(value)[1]))
 
 
+class RecurringDonationFilter(django_filters.FilterSet):
+    by_user = django_filters.CharFilter(method='filter_by_user')
+    active = django_filters.BooleanFilter()
+    order_by = django_filters.OrderingFilter(fields=(('created', 'created'), ))
+
+    def filter_by_user(self, qs, name, value):
+        return qs.filter(Q(user_id=from_global_id(value)[1]))
+
+
 class EntryOrderingFilter(django_filters.OrderingFilter):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -149,6 +183,7 @@ class EntryFilter(django_filters.FilterSet):
             ('score', 'score'),
             ('created', 'created'),
             ('like_count', 'like_count'),
+            ('trending', 'trending'),
         ))
 
     class Meta:
@@ -253,6 +288,7 @@ class EventFilter(EntryFilter):
             ('created', 'created'),
             ('date', 'date'),
             ('like_count', 'like_count'),
+            ('trending', 'trending'),
         ))
     search = django_filters.CharFilter(method='filter_search')
 
@@ -305,6 +341,7 @@ class CommentFilter(django_filters.FilterSet):
             ('score', 'score'),
             ('created', 'created'),
             ('like_count', 'like_count'),
+            ('trending', 'trending'),
         ))
 
     class Meta:
@@ -422,7 +459,7 @@ class WithdrawalNode(DjangoObjectType):
 class EntryNode(DjangoObjectType):
     description = graphene.String()
 
-    comments = DjangoFilterConnectionField(
+    comments = EntryConnectionField(
         lambda: CommentNode,
         filterset_class=CommentFilter,
     )
@@ -452,6 +489,14 @@ class EntryNode(DjangoObjectType):
         return models.Comment.objects.filter(parent=self).count()
 
     def resolve_comment_count_recursive(self, *args, **kwargs):
+        comment = self if isinstance(self, models.Comment) else getattr(
+            self, 'comment', None)
+
+        if comment is None:
+            return models.Comment.objects.filter(root_id=self.pk).count()
+
+        if comment.root_id is not None:
+            return comment.get_descendants().count()
 
         count = 0
         stack = list(models.Comment.objects.filter(parent=self))
@@ -539,6 +584,7 @@ class DonationCreate(Mutation):
         amount = graphene.Int(required=True)
         private = graphene.Boolean()
         score = graphene.Int()
+        idempotency_key = graphene.String()
 
     donation = graphene.Field(DonationNode)
 
@@ -551,6 +597,7 @@ class DonationCreate(Mutation):
             amount,
             private=False,
             score=0,
+            idempotency_key=None,
     ):
         if not (info.context.user.is_superuser
                 or info.context.user.id == int(from_global_id(user)[1])):
@@ -567,18 +614,20 @@ class DonationCreate(Mutation):
         target_obj = models.Nonprofit.objects.get(pk=from_global_id(target)[1])
 
         try:
-            assert user_obj.balance() - amount >= 0
-        except AssertionError:
+            donation = models.create_transfer(
+                models.Donation,
+                idempotency_key=idempotency_key,
+                user=user_obj,
+                description=description,
+                target=target_obj,
+                amount=amount,
+                private=private,
+                score=score,
+            )
+        except models.InsufficientBalance:
             raise GraphQLError('Balance would be below zero')
-
-        donation = models.Donation.objects.create(
-            user=user_obj,
-            description=description,
-            target=target_obj,
-            amount=amount,
-            private=private,
-            score=score,
-        )
+        except models.IdempotencyKeyInUse:
+            raise GraphQLError('Request is already in progress')
 
         return DonationCreate(donation=donation)
 
@@ -629,6 +678,7 @@ class TransactionCreate(Mutation):
         amount = graphene.Int(required=True)
         private = graphene.Boolean()
         score = graphene.Int()
+        idempotency_key = graphene.String()
 
     transaction = graphene.Field(TransactionNode)
 
@@ -641,6 +691,7 @@ class TransactionCreate(Mutation):
             amount,
             private=False,
             score=0,
+            idempotency_key=None,
     ):
         if not (info.context.user.is_superuser
                 or info.context.user.id == int(from_global_id(user)[1])):
@@ -657,20 +708,173 @@ class TransactionCreate(Mutation):
         target_obj = models.Person.objects.get(pk=from_global_id(target)[1])
 
         try:
-            assert user_obj.balance() - amount >= 0
+            transaction = models.create_transfer(
+                models.Transaction,
+                idempotency_key=idempotency_key,
+                user=user_obj,
+                description=description,
+                target=target_obj,
+                amount=amount,
+                private=private,
+                score=score,
+            )
+        except models.InsufficientBalance:
+            raise GraphQLError('Balance would be below zero')
+        except models.IdempotencyKeyInUse:
+            raise GraphQLError('Request is already in progress')
+
+        return TransactionCreate(transaction=transaction)
+
+
+# --- Transfers ------------------------------------------------------------- #
+
+
+class TransferInput(graphene.InputObjectType):
+    description = graphene.String(required=True)
+    target = graphene.ID(required=True)
+    amount = graphene.Int(required=True)
+    private = graphene.Boolean()
+    score = graphene.Int()
+
+
+class TransfersCreate(Mutation):
+    class Arguments:
+        user = graphene.ID(required=True)
+        transfers = graphene.List(TransferInput, required=True)
+
+    donations = graphene.List(DonationNode)
+    transactions = graphene.List(TransactionNode)
+
+    def mutate(self, info, user, transfers):
+        if not (info.context.user.is_superuser
+                or info.context.user.id == int(from_global_id(user)[1])):
+            raise GraphQLError('You do not have sufficient permission')
+
+        try:
+            assert 0 < len(transfers) <= settings.MAX_TRANSFER_BATCH
+            for x in transfers:
+                assert len(x.description) > 0
+                assert x.amount > 0
+                assert x.amount <= settings.MAX_TRANSFER
         except AssertionError:
+            raise GraphQLError('Arguments do not satisfy constraints')
+
+        user_obj = models.IbisUser.objects.get(pk=from_global_id(user)[1])
+
+        try:
+            target_ids = [int(from_global_id(x.target)[1]) for x in transfers]
+        except (ValueError, TypeError):
+            raise GraphQLError('Transfer target does not exist')
+
+        targets = models.Nonprofit.objects.in_bulk(target_ids)
+        targets.update(models.Person.objects.in_bulk(target_ids))
+
+        try:
+            transfers = [{
+                'target': targets[target_id],
+                'description': x.description,
+                'amount': x.amount,
+                'private': bool(x.private),
+                'score': x.score or 0,
+            } for x, target_id in zip(transfers, target_ids)]
+        except KeyError:
+            raise GraphQLError('Transfer target does not exist')
+
+        try:
+            instances = models.create_transfers(user_obj, transfers)
+        except models.InsufficientBalance:
             raise GraphQLError('Balance would be below zero')
 
-        transaction = models.Transaction.objects.create(
-            user=user_obj,
+        return TransfersCreate(
+            donations=[
+                x for x in instances if isinstance(x, models.Donation)
+            ],
+            transactions=[
+                x for x in instances if isinstance(x, models.Transaction)
+            ],
+        )
+
+
+# --- Recurring Donation ---------------------------------------------------- #
+
+
+class RecurringDonationNode(DjangoObjectType):
+    class Meta:
+        model = models.RecurringDonation
+        filter_fields = []
+        interfaces = (relay.Node, )
+
+    @classmethod
+    def get_queryset(cls, queryset, info):
+        if not info.context.user.is_authenticated:
+            raise GraphQLError('You are not logged in')
+
+        if info.context.user.is_superuser:
+            return queryset
+
+        return queryset.filter(user=info.context.user)
+
+
+class RecurringDonationCreate(Mutation):
+    class Arguments:
+        user = graphene.ID(required=True)
+        description = graphene.String(required=True)
+        target = graphene.ID(required=True)
+        amount = graphene.Int(required=True)
+        private = graphene.Boolean()
+
+    recurring_donation = graphene.Field(RecurringDonationNode)
+
+    def mutate(
+            self,
+            info,
+            user,
+            description,
+            target,
+            amount,
+            private=False,
+    ):
+        if not (info.context.user.is_superuser
+                or info.context.user.id == int(from_global_id(user)[1])):
+            raise GraphQLError('You do not have sufficient permission')
+
+        try:
+            assert len(description) > 0
+            assert amount > 0
+            assert amount <= settings.MAX_TRANSFER
+        except AssertionError:
+            raise GraphQLError('Arguments do not satisfy constraints')
+
+        recurring_donation = models.RecurringDonation.objects.create(
+            user=models.IbisUser.objects.get(pk=from_global_id(user)[1]),
+            target=models.Nonprofit.objects.get(
+                pk=from_global_id(target)[1]),
             description=description,
-            target=target_obj,
             amount=amount,
             private=private,
-            score=score,
         )
 
-        return TransactionCreate(transaction=transaction)
+        return RecurringDonationCreate(recurring_donation=recurring_donation)
+
+
+class RecurringDonationDelete(Mutation):
+    class Arguments:
+        id = graphene.ID(required=True)
+
+    state = graphene.Boolean()
+
+    def mutate(self, info, id):
+        recurring_donation = models.RecurringDonation.objects.get(
+            pk=from_global_id(id)[1])
+
+        if not (info.context.user.is_superuser
+                or info.context.user.id == recurring_donation.user_id):
+            raise GraphQLError('You do not have sufficient permission')
+
+        recurring_donation.active = False
+        recurring_donation.save()
+
+        return RecurringDonationDelete(state=recurring_donation.active)
 
 
 # --- News ------------------------------------------------------------------ #
@@ -1033,6 +1237,48 @@ class IbisUserNode(UserNode):
         return queryset
 
 
+# --- Account Statement ----------------------------------------------------- #
+
+
+class StatementEntryNode(graphene.ObjectType):
+    kind = graphene.String()
+    reference = graphene.ID()
+    counterparty = graphene.ID()
+    created = graphene.DateTime()
+    amount = graphene.Int()
+    balance = graphene.Int()
+
+
+class StatementConnection(relay.Connection):
+    class Meta:
+        node = StatementEntryNode
+
+
+def _to_statement_cursor(user_id, row):
+    # signed, since the next page trusts the balance stored in the cursor
+    return signing.dumps(
+        [
+            user_id,
+            row['created'].isoformat(),
+            row['kind'],
+            row['id'],
+            row['inbound'],
+            row['balance'] - row['amount'],
+        ],
+        salt=STATEMENT_CURSOR_SALT,
+    )
+
+
+def _from_statement_cursor(user_id, cursor):
+    try:
+        owner, created, kind, id, inbound, balance = signing.loads(
+            cursor, salt=STATEMENT_CURSOR_SALT)
+        assert owner == user_id
+        return dateutil.parser.parse(created), kind, id, inbound, balance
+    except (signing.BadSignature, ValueError, TypeError, AssertionError):
+        raise GraphQLError('Invalid cursor')
+
+
 # --- Nonprofit ------------------------------------------------------------- #
 
 
@@ -1174,6 +1420,7 @@ class NonprofitUpdate(Mutation):
 class PersonNode(IbisUserNode, UserNode):
 
     donated = graphene.Int()
+    distribution_forecast = graphene.Int()
 
     class Meta:
         model = models.Person
@@ -1184,6 +1431,18 @@ class PersonNode(IbisUserNode, UserNode):
     def resolve_donated(self, *args, **kwargs):
         return self.donated()
 
+    def resolve_distribution_forecast(self, *args, **kwargs):
+        return distribution.models.Forecast.get_payout(self, localtime())
+
+
+class DistributionForecastNode(graphene.ObjectType):
+    step = graphene.DateTime()
+    amount = graphene.Int()
+    recipients = graphene.Int()
+
+    def resolve_amount(self, *args, **kwargs):
+        return int(round(self.amount))
+
 
 class PersonUpdate(Mutation):
     class Arguments:
@@ -1577,6 +1836,7 @@ class Query(object):
     deposit = relay.Node.Field(DepositNode)
     donation = relay.Node.Field(DonationNode)
     transaction = relay.Node.Field(TransactionNode)
+    recurring_donation = relay.Node.Field(RecurringDonationNode)
     news = relay.Node.Field(NewsNode)
     event = relay.Node.Field(EventNode)
     post = relay.Node.Field(PostNode)
@@ -1609,36 +1869,124 @@ class Query(object):
         WithdrawalNode,
         filterset_class=WithdrawalFilter,
     )
-    all_donations = DjangoFilterConnectionField(
+    all_donations = EntryConnectionField(
         DonationNode,
         filterset_class=DonationFilter,
     )
-    all_transactions = DjangoFilterConnectionField(
+    all_transactions = EntryConnectionField(
         TransactionNode,
         filterset_class=TransactionFilter,
     )
-    all_news = DjangoFilterConnectionField(
+    all_recurring_donations = DjangoFilterConnectionField(
+        RecurringDonationNode,
+        filterset_class=RecurringDonationFilter,
+    )
+    all_news = EntryConnectionField(
         NewsNode,
         filterset_class=NewsFilter,
     )
-    all_events = DjangoFilterConnectionField(
+    all_events = EntryConnectionField(
         EventNode,
         filterset_class=EventFilter,
     )
-    all_posts = DjangoFilterConnectionField(
+    all_posts = EntryConnectionField(
         PostNode,
         filterset_class=PostFilter,
     )
-    all_comments = DjangoFilterConnectionField(
+    all_comments = EntryConnectionField(
         CommentNode,
         filterset_class=CommentFilter,
     )
 
+    account_statement = relay.ConnectionField(
+        StatementConnection,
+        user=graphene.ID(required=True),
+    )
+
+    distribution_forecast = graphene.Field(DistributionForecastNode)
+
+    autocomplete_users = graphene.List(
+        IbisUserNode,
+        search=graphene.String(required=True),
+    )
+
+    def resolve_distribution_forecast(self, info, *args, **kwargs):
+        if not info.context.user.is_authenticated:
+            raise GraphQLError('You are not logged in')
+
+        return distribution.models.Forecast.objects.filter(
+            step=distribution.models.to_step_start(localtime(),
+                                                   offset=1)).first()
+
+    def resolve_autocomplete_users(self, info, search, *args, **kwargs):
+        if not info.context.user.is_authenticated:
+            raise GraphQLError('You are not logged in')
+
+        return models.autocomplete_users(
+            info.context.user,
+            search,
+            settings.AUTOCOMPLETE_SIZE,
+        )
+
+    def resolve_account_statement(
+            self,
+            info,
+            user,
+            first=STATEMENT_PAGE_SIZE,
+            after=None,
+            **kwargs,
+    ):
+        if not (info.context.user.is_superuser
+                or info.context.user.id == int(from_global_id(user)[1])):
+            raise GraphQLError('You do not have sufficient permission')
+
+        if kwargs.get('last') or kwargs.get('before'):
+            raise GraphQLError('Statements only support forward pagination')
+
+        if first < 1 or first > STATEMENT_PAGE_MAX:
+            raise GraphQLError('Arguments do not satisfy constraints')
+
+        user_obj = models.IbisUser.objects.get(pk=from_global_id(user)[1])
+        rows = user_obj.statement(
+            first + 1,
+            after=_from_statement_cursor(user_obj.id, after)
+            if after else None,
+        )
+
+        edges = [
+            StatementConnection.Edge(
+                node=StatementEntryNode(
+                    kind=x['kind'],
+                    reference=to_global_id('{}Node'.format(x['kind']),
+                                           x['id']),
+                    counterparty=to_global_id('IbisUserNode',
+                                              x['counterparty_id'])
+                    if x['counterparty_id'] else None,
+                    created=x['created'],
+                    amount=x['amount'],
+                    balance=x['balance'],
+                ),
+                cursor=_to_statement_cursor(user_obj.id, x),
+            ) for x in rows[:first]
+        ]
+
+        return StatementConnection(
+            edges=edges,
+            page_info=relay.PageInfo(
+                start_cursor=edges[0].cursor if edges else None,
+                end_cursor=edges[-1].cursor if edges else None,
+                has_previous_page=bool(after),
+                has_next_page=len(rows) > first,
+            ),
+        )
+
 
 class Mutation(graphene.ObjectType):
     create_deposit = DepositCreate.Field()
     create_donation = DonationCreate.Field()
     create_transaction = TransactionCreate.Field()
+    create_transfers = TransfersCreate.Field()
+    create_recurring_donation = RecurringDonationCreate.Field()
     create_news = NewsCreate.Field()
     create_event = EventCreate.Field()
     create_post = PostCreate.Field()
@@ -1654,6 +2002,7 @@ class Mutation(graphene.ObjectType):
     update_news = NewsUpdate.Field()
     update_event = EventUpdate.Field()
 
+    delete_recurring_donation = RecurringDonationDelete.Field()
     delete_follow = FollowDelete.Field()
     delete_like = LikeDelete.Field()
     delete_bookmark = BookmarkDelete.Field()
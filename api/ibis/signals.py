@@ -1,22 +1,115 @@
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.db.models.signals import m2m_changed
 from django.conf import settings
 
 import ibis.models as models
 
 
-def scoreFundraisedDescending(sender, instance, created, raw, **kwargs):
+def scoreFundraisedDescending(sender, created=True, raw=False, **kwargs):
     if raw or not created:
         return
 
-    nonprofits = list(
-        models.Nonprofit.objects.exclude(username=settings.IBIS_USERNAME_ROOT))
-    nonprofits.sort(key=lambda x: x.fundraised(), reverse=True)
-    for i, nonprofit in enumerate(nonprofits):
-        if nonprofit.score != i + 1:
-            nonprofit.score = i + 1
-            nonprofit.save()
+    # re-rank after the donation commits, outside of its account locks
+    transaction.on_commit(models.rank_nonprofits)
 
 
+def createAccount(sender, instance, created, raw, **kwargs):
+    if raw or not created:
+        return
+
+    models.Account.objects.get_or_create(user_id=instance.id)
+
+
+def reverseTransferDelete(sender, instance, **kwargs):
+    instance.apply_to_accounts(sign=-1, create=False)
+
+
+def bumpReferenceVersion(sender, **kwargs):
+    models.bump_reference_version()
+
+
+def bumpRootReferenceVersion(sender, instance, **kwargs):
+    if instance.username == settings.IBIS_USERNAME_ROOT:
+        models.bump_reference_version()
+
+
+def invalidateRenderedDescription(sender, instance, raw, **kwargs):
+    if raw or instance._state.adding:
+        return
+
+    # rendered descriptions spell out the usernames of mentioned users
+    if models.User.objects.filter(pk=instance.pk).exclude(
+            username=instance.username).exists():
+        models.Entry.objects.filter(mention=instance.pk).update(
+            rendered_description=None)
+
+
+def markEngagementTrending(sender, instance, action, reverse, model, pk_set,
+                           **kwargs):
+    if not reverse:
+        if action in ['post_add', 'post_remove', 'post_clear']:
+            models.mark_trending_stale([instance.pk])
+    elif action in ['post_add', 'post_remove'] and pk_set:
+        models.mark_trending_stale(pk_set)
+    elif action == 'pre_clear':
+        # clears do not pass the entry ids, so look them up while they exist
+        fields = [x for x in sender._meta.get_fields() if x.many_to_one]
+        entry = next(x for x in fields if x.related_model == model)
+        user = next(x for x in fields if x is not entry)
+        models.mark_trending_stale(
+            sender.objects.filter(**{
+                user.name: instance.pk
+            }).values_list(entry.attname, flat=True))
+
+
+def markCommentTrending(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+
+    models.mark_trending_stale([instance.parent_id])
+
+
+for model in [
+        models.IbisUser,
+        models.Person,
+        models.Nonprofit,
+        models.Bot,
+]:
+    post_save.connect(createAccount, sender=model)
+
+for model in [
+        models.User,
+        models.IbisUser,
+        models.Person,
+        models.Nonprofit,
+        models.Bot,
+]:
+    pre_save.connect(invalidateRenderedDescription, sender=model)
+
+for model in [
+        models.Deposit,
+        models.Withdrawal,
+        models.Donation,
+        models.Transaction,
+]:
+    post_delete.connect(reverseTransferDelete, sender=model)
+
+post_save.connect(bumpReferenceVersion, sender=models.DepositCategory)
+post_delete.connect(bumpReferenceVersion, sender=models.DepositCategory)
+post_save.connect(bumpRootReferenceVersion, sender=models.Nonprofit)
+post_delete.connect(bumpRootReferenceVersion, sender=models.Nonprofit)
+
+for through in [
+        models.Entry.like.through,
+        models.Entry.mention.through,
+        models.Event.rsvp.through,
+]:
+    m2m_changed.connect(markEngagementTrending, sender=through)
+
+post_save.connect(markCommentTrending, sender=models.Comment)
+post_delete.connect(markCommentTrending, sender=models.Comment)
+
 score_nonprofit = {
     'fundraised_descending': scoreFundraisedDescending,
 }
@@ -26,3 +119,7 @@ if settings.SIGNAL_SCORE_NONPROFIT:
         score_nonprofit[settings.SIGNAL_SCORE_NONPROFIT],
         sender=models.Donation,
     )
+    models.transfers_created.connect(
+        score_nonprofit[settings.SIGNAL_SCORE_NONPROFIT],
+        sender=models.Donation,
+    )
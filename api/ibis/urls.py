@@ -11,4 +11,5 @@ urlpatterns = [
     path('logout/', views.LogoutView.as_view(), name='logout'),
     path('identify/', views.IdentifyView.as_view(), name='identify'),
     path('payment/', views.PaymentView.as_view(), name='payment'),
+    path('export/', views.ExportView.as_view(), name='export'),
 ]
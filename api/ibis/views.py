@@ -1,5 +1,8 @@
 import os
 import sys
+import csv
+import heapq
+import itertools
 import random
 import json
 import requests
@@ -11,11 +14,16 @@ from django.core.exceptions import ValidationError
 from django.contrib.auth.password_validation import validate_password
 from django.contrib.auth import login, logout, authenticate
 from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import Q
+from django.http import StreamingHttpResponse
 from rest_framework import generics, response, exceptions, serializers
+from rest_framework import status
 from users.models import User
 from allauth.socialaccount.models import SocialAccount
-from graphql_relay.node.node import to_global_id
-from django.utils.timezone import localtime, now
+from graphql_relay.node.node import to_global_id, from_global_id
+from django.utils.timezone import localtime, now, make_aware, is_naive
+from dateutil.parser import parse as parse_date
 
 import ibis.models as models
 from .serializers import PasswordLoginSerializer, PasswordChangeSerializer
@@ -26,6 +34,16 @@ logger = logging.getLogger(__name__)
 
 QUOTE_URL = 'https://api.forismatic.com/api/1.0/?method=getQuote&lang=en&format=jsonp&jsonp=?'
 FB_AVATAR = 'https://graph.facebook.com/v4.0/{}/picture?type=large'
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_COLUMNS = [
+    'type',
+    'id',
+    'created',
+    'user',
+    'target',
+    'amount',
+    'description',
+]
 ANONYMOUS_AVATAR = 'https://s3.us-east-2.amazonaws.com/app.tokenibis.org/miscellaneous/confused_robot.jpg'
 
 
@@ -86,11 +104,6 @@ class LoginView(generics.GenericAPIView):
             person = models.Person(user_ptr_id=request.user.id)
             person.__dict__.update(user.__dict__)
 
-            person.username = models.generate_valid_username(
-                person.first_name,
-                person.last_name,
-            )
-
             if social_account.provider == 'facebook':
                 person.avatar = FB_AVATAR.format(social_account.uid)
             else:
@@ -98,7 +111,20 @@ class LoginView(generics.GenericAPIView):
                     hash(str(request.user.id)) % settings.AVATAR_BUCKET_LEN)
 
             person.score = 0
-            person.save()
+
+            # another signup may claim the same username in the meantime
+            for attempt in range(settings.USERNAME_RETRIES):
+                person.username = models.generate_valid_username(
+                    person.first_name,
+                    person.last_name,
+                )
+                try:
+                    with transaction.atomic():
+                        person.save()
+                    break
+                except IntegrityError:
+                    if attempt + 1 == settings.USERNAME_RETRIES:
+                        raise
 
         return response.Response({
             'user_id':
@@ -247,6 +273,24 @@ class PaymentView(generics.GenericAPIView):
         serializerform = self.get_serializer(data=request.data)
         if not serializerform.is_valid():
             raise exceptions.ParseError(detail="No valid values")
+
+        user = models.IbisUser.objects.get(pk=request.user.id)
+
+        # retried requests return the original deposit without asking PayPal
+        idempotency_key = request.META.get(
+            'HTTP_IDEMPOTENCY_KEY') or request.data.get('idempotencyKey')
+        if idempotency_key:
+            reference = models.IdempotencyKey.lookup(
+                user,
+                models.Deposit.__name__,
+                idempotency_key,
+            )
+            if reference:
+                return response.Response({
+                    'depositID':
+                    to_global_id('DepositNode', reference),
+                })
+
         payment_id, net, fee = self.paypal_client.get_order(
             request.data['orderID'])
 
@@ -256,15 +300,134 @@ class PaymentView(generics.GenericAPIView):
                 'depositID': '',
             })
 
-        user = models.IbisUser.objects.get(pk=request.user.id)
-        deposit = models.Deposit.objects.create(
-            user=user,
-            amount=net,
-            payment_id='paypal:{}:{}'.format(fee, payment_id),
-            category=models.DepositCategory.objects.get(title='paypal'),
-        )
+        with transaction.atomic():
+            if idempotency_key:
+                claim = models.IdempotencyKey.claim(
+                    user,
+                    models.Deposit.__name__,
+                    idempotency_key,
+                )
+                if not claim:
+                    reference = models.IdempotencyKey.lookup(
+                        user,
+                        models.Deposit.__name__,
+                        idempotency_key,
+                    )
+
+                    # claimed, but its deposit is not linked yet
+                    if not reference:
+                        return response.Response(
+                            {'depositID': ''},
+                            status=status.HTTP_409_CONFLICT,
+                        )
+
+                    return response.Response({
+                        'depositID':
+                        to_global_id('DepositNode', reference),
+                    })
+
+            deposit = models.Deposit.objects.create(
+                user=user,
+                amount=net,
+                payment_id='paypal:{}:{}'.format(fee, payment_id),
+                category=models.get_deposit_category('paypal'),
+            )
+
+            if idempotency_key:
+                claim.reference = deposit.id
+                claim.save()
 
         return response.Response({
             'depositID':
             to_global_id('DepositNode', deposit.id),
         })
+
+
+class Echo:
+    # pseudo-buffer so that csv.writer returns rows instead of storing them
+    def write(self, value):
+        return value
+
+
+class ExportView(generics.GenericAPIView):
+    def get(self, request, *args, **kwargs):
+        try:
+            nonprofit = models.Nonprofit.objects.get(
+                pk=from_global_id(request.GET['nonprofit'])[1])
+            start, end = [
+                parse_date(request.GET[x]) if x in request.GET else None
+                for x in ['start', 'end']
+            ]
+            start, end = [
+                make_aware(x) if x and is_naive(x) else x
+                for x in [start, end]
+            ]
+            output = request.GET.get('output', 'csv')
+            assert output in ['csv', 'jsonl']
+        except (KeyError, ValueError, AssertionError,
+                models.Nonprofit.DoesNotExist):
+            raise exceptions.ParseError(detail='No valid values')
+
+        if not (request.user.is_superuser or request.user.id == nonprofit.id):
+            raise exceptions.PermissionDenied(
+                detail='You do not have sufficient permission')
+
+        def _filter(queryset):
+            if start:
+                queryset = queryset.filter(created__gte=start)
+            if end:
+                queryset = queryset.filter(created__lt=end)
+            return queryset.order_by('created', 'id').iterator(
+                chunk_size=EXPORT_CHUNK_SIZE)
+
+        def _rendered(entries):
+            # descriptions are rendered as users see them, chunk by chunk
+            while True:
+                chunk = list(itertools.islice(entries, EXPORT_CHUNK_SIZE))
+                if not chunk:
+                    return
+                models.render_descriptions(chunk)
+                yield from chunk
+
+        # both streams are sorted, so merging them keeps memory constant
+        rows = heapq.merge(
+            (('Donation', x.id, x.created, x.user.username,
+              x.target.username, x.amount, x.rendered_description)
+             for x in _rendered(
+                 _filter(
+                     models.Donation.objects.filter(
+                         Q(target=nonprofit)
+                         | Q(user=nonprofit)).select_related(
+                             'user', 'target')))),
+            (('Withdrawal', x[0], x[1], x[2], '') + x[3:] for x in _filter(
+                models.Withdrawal.objects.filter(user=nonprofit).values_list(
+                    'id',
+                    'created',
+                    'user__username',
+                    'amount',
+                    'description',
+                ))),
+            key=lambda x: (x[2], x[0], x[1]),
+        )
+
+        def _format(row):
+            return [
+                row[0],
+                to_global_id('{}Node'.format(row[0]), row[1]),
+                localtime(row[2]).isoformat(),
+            ] + list(row[3:])
+
+        if output == 'csv':
+            writer = csv.writer(Echo())
+            content = (writer.writerow(x) for x in itertools.chain(
+                [EXPORT_COLUMNS], (_format(x) for x in rows)))
+            content_type = 'text/csv'
+        else:
+            content = (json.dumps(dict(zip(EXPORT_COLUMNS, _format(x)))) +
+                       '\n' for x in rows)
+            content_type = 'application/x-ndjson'
+
+        streaming = StreamingHttpResponse(content, content_type=content_type)
+        streaming['Content-Disposition'] = 'attachment; filename="{}.{}"'.\
+            format(nonprofit.username, output)
+        return streaming
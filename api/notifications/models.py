@@ -29,9 +29,61 @@ with open(os.path.join(DIR, 'top_email_templates/html.html')) as fd:
 
 
 def get_submodel(instance, supermodel):
-    for submodel in supermodel.__subclasses__():
-        if submodel.objects.filter(pk=instance.pk).exists():
-            return submodel
+    # cached on the instance, which is often the subject of many emails
+    cache = instance.__dict__.setdefault('_submodels', {})
+    if supermodel not in cache:
+        cache[supermodel] = next(
+            (x for x in supermodel.__subclasses__()
+             if x.objects.filter(pk=instance.pk).exists()),
+            None,
+        )
+    return cache[supermodel]
+
+
+def bulk_create_notifications(notifications,
+                              template_model,
+                              email_field,
+                              schedule=None,
+                              force=False):
+    """Insert a list of notifications of the same type along with their
+    emails in bulk. Emails are scheduled for notifiers that enabled the
+    given email setting, as when the notifications are saved one by one.
+    """
+
+    if STATE['LOADING_DATA']:
+        for notification in notifications:
+            notification.clicked = True
+
+    ibis.models.bulk_create_inherited(notifications)
+
+    if STATE['LOADING_DATA']:
+        return notifications
+
+    templates = template_model.active()
+    emails = []
+
+    for notification in notifications:
+        if not getattr(notification.notifier, email_field):
+            continue
+        if not templates:
+            logger.error('No email template found')
+            continue
+        subject, body, html = random.choice(templates).make_email(
+            notification, notification.subject)
+        emails.append(
+            Email(
+                notification=notification,
+                subject=subject,
+                body=body,
+                html=html,
+                schedule=schedule or now() +
+                timedelta(minutes=settings.EMAIL_DELAY),
+                force=force,
+            ))
+
+    Email.objects.bulk_create(emails)
+
+    return notifications
 
 
 class Notifier(models.Model):
@@ -153,8 +205,8 @@ class UbpNotification(Notification):
 
         if not STATE['LOADING_DATA'] and self.notifier.email_ubp:
             if self.notifier.email_ubp and self.subject.user.ibisuser.deposit_set.filter(
-                    category=ibis.models.DepositCategory.objects.get(
-                        title='ubp')).count() == 1:
+                    category=ibis.models.get_deposit_category(
+                        'ubp')).count() == 1:
                 try:
                     subject, body, html = EmailTemplateWelcome.choose(
                     ).make_email(self, self.subject)
@@ -470,9 +522,16 @@ class EmailTemplate(models.Model):
         ]) != set(content_keys):
             raise ValidationError('HTML template has invalid key set')
 
+    @classmethod
+    def active(cls):
+        return ibis.models.get_reference(
+            cls.__name__,
+            lambda: list(cls.objects.filter(frequency__gte=1)),
+        )
+
     @classmethod
     def choose(cls):
-        return random.choice(list(cls.objects.filter(frequency__gte=1)))
+        return random.choice(cls.active())
 
     @staticmethod
     def _apply_top_template(notifier, subject, body, html):
@@ -1,8 +1,10 @@
 import ibis.models
 import notifications.models as models
 
-from django.db.models.signals import post_save, m2m_changed
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.dispatch import receiver
+from django.utils.timezone import now
 from graphql_relay.node.node import to_global_id
 
 
@@ -11,9 +13,12 @@ def handleDepositCreate(sender, instance, created, **kwargs):
     if not created:
         return
 
-    if ibis.models.DepositCategory.objects.filter(title='ubp').exists(
-    ) and instance.category == ibis.models.DepositCategory.objects.get(
-            title='ubp'):
+    try:
+        ubp = ibis.models.get_deposit_category(settings.IBIS_CATEGORY_UBP)
+    except ibis.models.DepositCategory.DoesNotExist:
+        ubp = None
+
+    if ubp and instance.category_id == ubp.id:
         description = 'You have a fresh ${:.2f} waiting for you'.format(
             instance.amount / 100)
 
@@ -44,6 +49,81 @@ def handleDepositCreate(sender, instance, created, **kwargs):
         )
 
 
+@receiver(ibis.models.transfers_created, sender=ibis.models.Deposit)
+def handleDepositsCreate(sender, instances, **kwargs):
+    try:
+        ubp = ibis.models.get_deposit_category(settings.IBIS_CATEGORY_UBP)
+    except ibis.models.DepositCategory.DoesNotExist:
+        ubp = None
+
+    notifiers = models.Notifier.objects.select_related('user').in_bulk(
+        set(x.user_id for x in instances))
+
+    # a user's first UBP deposit gets the welcome email instead
+    welcomed = set(
+        ibis.models.Deposit.objects.filter(
+            category=ubp,
+            user_id__in=notifiers.keys(),
+        ).exclude(id__in=[x.id for x in instances]).values_list(
+            'user_id', flat=True))
+
+    ubp_notifications = []
+    welcome_notifications = []
+    deposit_notifications = []
+
+    for instance in instances:
+        if instance.user_id not in notifiers:
+            notifiers[instance.user_id] = instance.user.notifier
+
+        reference = '{}:{}'.format(
+            ibis.models.Deposit.__name__,
+            to_global_id('DepositNode', instance.pk),
+        )
+
+        if ubp and instance.category_id == ubp.id:
+            notification = models.UbpNotification(
+                notifier=notifiers[instance.user_id],
+                reference=reference,
+                description='You have a fresh ${:.2f} waiting for you'.format(
+                    instance.amount / 100),
+                subject=instance,
+                created=instance.created,
+            )
+            if instance.user_id in welcomed:
+                ubp_notifications.append(notification)
+            else:
+                welcomed.add(instance.user_id)
+                welcome_notifications.append(notification)
+        else:
+            deposit_notifications.append(
+                models.DepositNotification(
+                    notifier=notifiers[instance.user_id],
+                    reference=reference,
+                    description='Your deposit of ${:.2f} was successful'.
+                    format(instance.amount / 100),
+                    subject=instance,
+                    created=instance.created,
+                ))
+
+    models.bulk_create_notifications(
+        ubp_notifications,
+        models.EmailTemplateUBP,
+        'email_ubp',
+    )
+    models.bulk_create_notifications(
+        welcome_notifications,
+        models.EmailTemplateWelcome,
+        'email_ubp',
+        schedule=now(),
+        force=True,
+    )
+    models.bulk_create_notifications(
+        deposit_notifications,
+        models.EmailTemplateDeposit,
+        'email_deposit',
+    )
+
+
 @receiver(post_save, sender=ibis.models.Donation)
 def handleDonationCreate(sender, instance, created, **kwargs):
     if not created:
@@ -92,6 +172,54 @@ def handleTransactionCreate(sender, instance, created, **kwargs):
     )
 
 
+@receiver(ibis.models.transfers_created, sender=ibis.models.Donation)
+@receiver(ibis.models.transfers_created, sender=ibis.models.Transaction)
+def handleTransfersCreate(sender, instances, **kwargs):
+    notification_model, template_model, email_field, description = {
+        ibis.models.Donation: (
+            models.DonationNotification,
+            models.EmailTemplateDonation,
+            'email_donation',
+            '{} donated ${:.2f}',
+        ),
+        ibis.models.Transaction: (
+            models.TransactionNotification,
+            models.EmailTemplateTransaction,
+            'email_transaction',
+            '{} sent you ${:.2f}',
+        ),
+    }[sender]
+
+    notifiers = models.Notifier.objects.select_related('user').in_bulk(
+        set(x.target_id for x in instances))
+
+    notifications = []
+    for instance in instances:
+        if instance.target_id not in notifiers:
+            notifiers[instance.target_id] = instance.target.notifier
+        notifications.append(
+            notification_model(
+                notifier=notifiers[instance.target_id],
+                reference='{}:{}'.format(
+                    sender.__name__,
+                    to_global_id('{}Node'.format(sender.__name__),
+                                 instance.pk),
+                ),
+                description=description.format(
+                    str(instance.user),
+                    instance.amount / 100,
+                ),
+                subject=instance,
+                created=instance.created,
+            ))
+
+    models.bulk_create_notifications(
+        notifications,
+        template_model,
+        email_field,
+    )
+
+
 @receiver(post_save, sender=ibis.models.News)
 def handleNewsCreate(sender, instance, created, **kwargs):
     if not created:
@@ -165,33 +293,29 @@ def handleCommentCreate(sender, instance, created, **kwargs):
         return
 
     entry = ibis.models.Entry.objects.get(pk=instance.pk)
-    current = instance
+
+    # every parent below the root of the thread is a comment itself
+    ids = instance.get_ancestor_ids()
+    parents = ibis.models.Entry.objects.select_related('user').in_bulk(ids)
+    root = parents[ids[0]]
+    root_type = models.get_submodel(root, ibis.models.Entry)
 
     notification_info = []
 
-    while hasattr(current, 'comment'):
-        parent = current.comment.parent
-        notifiers = [parent.user.ibisuser.notifier]
-        if models.get_submodel(
-                parent,
-                ibis.models.Entry,
-        ) == ibis.models.Donation:
-            notifiers.append(parent.donation.target.ibisuser.notifier)
-        if models.get_submodel(
-                parent,
-                ibis.models.Entry,
-        ) == ibis.models.Transaction:
-            notifiers.append(parent.transaction.target.ibisuser.notifier)
+    for parent in reversed([parents[x] for x in ids]):
+        parent_type = root_type if parent == root else ibis.models.Comment
+        notifiers = [parent.user.notifier]
+        if parent_type == ibis.models.Donation:
+            notifiers.append(parent.donation.target.notifier)
+        if parent_type == ibis.models.Transaction:
+            notifiers.append(parent.transaction.target.notifier)
 
         for notifier in notifiers:
             if notifier not in [x['notifier'] for x in notification_info
                                 ] and notifier != entry.user.notifier:
                 description = '{} replied to your {}'.format(
                     str(entry.user),
-                    models.get_submodel(
-                        parent,
-                        ibis.models.Entry,
-                    ).__name__.lower(),
+                    parent_type.__name__.lower(),
                 )
                 notification_info.append({
                     'notifier': notifier,
@@ -199,10 +323,8 @@ def handleCommentCreate(sender, instance, created, **kwargs):
                     'subject': instance,
                 })
 
-        current = parent
-
-    ref_type = models.get_submodel(current, ibis.models.Entry).__name__
-    ref_id = to_global_id('{}Node'.format(ref_type), current.pk)
+    ref_type = root_type.__name__
+    ref_id = to_global_id('{}Node'.format(ref_type), root.pk)
     reference = '{}:{}'.format(ref_type, ref_id)
 
     if notification_info:
@@ -256,29 +378,22 @@ def handleFollowUpdate(sender, instance, action, pk_set, **kwargs):
 def handleLikeUpdate(sender, instance, action, pk_set, **kwargs):
     entry = ibis.models.Entry.objects.get(pk=instance.pk)
     if action == 'post_add':
+        entry_type = models.get_submodel(entry, ibis.models.Entry)
+        root = entry.comment.get_root(
+        ) if entry_type == ibis.models.Comment else entry
+        ref_type = models.get_submodel(
+            root,
+            ibis.models.Entry,
+        ).__name__ if root != entry else entry_type.__name__
+
         for pk in pk_set:
             user = ibis.models.IbisUser.objects.get(pk=pk)
             notifier = entry.user.notifier
             description = '{} liked your {}'.format(
                 str(user),
-                models.get_submodel(
-                    entry,
-                    ibis.models.Entry,
-                ).__name__.lower(),
+                entry_type.__name__.lower(),
             )
 
-            root = entry
-            while models.get_submodel(
-                    root,
-                    ibis.models.Entry,
-            ) == ibis.models.Comment:
-                root = root.comment.parent
-
-            ref_type = models.get_submodel(
-                root,
-                ibis.models.Entry,
-            ).__name__
-
             models.LikeNotification.objects.create(
                 notifier=notifier,
                 reference='{}:{}'.format(
@@ -303,39 +418,58 @@ def handleLikeUpdate(sender, instance, action, pk_set, **kwargs):
 def handleMentionUpdate(sender, instance, action, pk_set, **kwargs):
     entry = ibis.models.Entry.objects.get(pk=instance.pk)
     if action == 'post_add':
-        for pk in pk_set:
-            if not ibis.models.IbisUser.objects.get(pk=pk).can_see(entry):
-                continue
-            description = '{} mentioned you in a {}'.format(
-                entry.user,
-                models.get_submodel(entry, ibis.models.Entry).__name__.lower(),
-            )
+        entry_type = models.get_submodel(entry, ibis.models.Entry)
+        description = '{} mentioned you in a {}'.format(
+            entry.user,
+            entry_type.__name__.lower(),
+        )
 
-            root = entry
-            while models.get_submodel(
-                    root,
-                    ibis.models.Entry,
-            ) == ibis.models.Comment:
-                root = root.comment.parent
+        root = entry.comment.get_root(
+        ) if entry_type == ibis.models.Comment else entry
+        ref_type = models.get_submodel(
+            root,
+            ibis.models.Entry,
+        ).__name__ if root != entry else entry_type.__name__
 
-            ref_type = models.get_submodel(
-                root,
-                ibis.models.Entry,
-            ).__name__
+        reference = '{}:{}'.format(
+            ref_type,
+            to_global_id('{}Node'.format(ref_type), root.pk),
+        )
 
-            models.MentionNotification.objects.create(
-                notifier=ibis.models.IbisUser.objects.get(pk=pk).notifier,
-                reference='{}:{}'.format(
-                    ref_type,
-                    to_global_id('{}Node'.format(ref_type), root.pk),
-                ),
-                description=description,
-                subject=entry,
-            )
+        notifiers = models.Notifier.objects.select_related('user').in_bulk(
+            pk_set)
+        missing = set(pk_set) - set(notifiers)
+        if missing:
+            models.Notifier.objects.bulk_create(
+                [models.Notifier(user_id=x) for x in missing])
+            notifiers.update(
+                models.Notifier.objects.select_related('user').in_bulk(
+                    missing))
+
+        models.bulk_create_notifications(
+            [
+                models.MentionNotification(
+                    notifier=notifiers[pk],
+                    reference=reference,
+                    description=description,
+                    subject=entry,
+                ) for pk in pk_set if notifiers[pk].user.can_see(root)
+            ],
+            models.EmailTemplateMention,
+            'email_mention',
+        )
 
     elif action == 'post_remove':
-        for pk in pk_set:
-            models.MentionNotification.objects.filter(
-                notifier=ibis.models.IbisUser.objects.get(pk=pk).notifier,
-                subject=entry,
-            ).delete()
+        models.MentionNotification.objects.filter(
+            notifier__in=pk_set,
+            subject=entry,
+        ).delete()
+
+
+def handleTemplateUpdate(sender, **kwargs):
+    ibis.models.bump_reference_version()
+
+
+for template in models.EmailTemplate.__subclasses__():
+    post_save.connect(handleTemplateUpdate, sender=template)
+    post_delete.connect(handleTemplateUpdate, sender=template)